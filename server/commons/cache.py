@@ -0,0 +1,55 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+	"""A bounded in-process cache evicting the least recently used entries.
+
+Entries expire ttl seconds after being set, or never if ttl is None. All
+operations are guarded by a lock, so a single instance can be shared by
+concurrent requests.
+"""
+
+	def __init__(self, max_size, ttl=None):
+		self._max_size = max_size
+		self._ttl = ttl
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		"""Returns the value cached at key, or None if missing or expired."""
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None or (entry[1] is not None and entry[1] < time.time()):
+				self.misses += 1
+				return None
+			self._entries[key] = entry
+			self.hits += 1
+			return entry[0]
+
+	def set(self, key, value):
+		expires = time.time() + self._ttl if self._ttl is not None else None
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (value, expires)
+			while len(self._entries) > self._max_size:
+				self._entries.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+	def __len__(self):
+		return len(self._entries)
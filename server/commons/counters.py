@@ -0,0 +1,118 @@
+"""Sharded counters of the entities of models declaring _counters.
+
+Each counter is spread over config.COUNTER_SHARDS entities, so concurrent
+writes rarely contend on the same entity group. An update adds to one random
+shard of each counter in a single transaction, or in the transaction of the
+write it counts, see update_in_transaction_async. A total reads every shard of
+its counter, so it costs O(shards) whatever the number of entities, and is
+cached in memcache for config.COUNTER_CACHE_TTL seconds.
+"""
+import random
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from server import config
+from server.models.counter_shards import CounterShards
+
+TOTAL_CACHE_PREFIX = 'counter:'
+NAME_SEPARATOR = ':'
+# Entity groups a cross-group transaction may write to.
+MAX_TRANSACTION_COUNTERS = 25
+
+
+def counter_name(kind, prop_name=None, value=None):
+	"""Returns the name of the counter of kind, or of the entities of kind whose prop_name equals value."""
+	if prop_name is None:
+		return kind
+	if isinstance(value, ndb.Key):
+		value = value.urlsafe()
+	return '%s%s%s=%s' % (kind, NAME_SEPARATOR, prop_name, value)
+
+
+def group_prefix(kind, prop_name):
+	"""Returns the prefix shared by the names of the counters of kind grouped by prop_name."""
+	return counter_name(kind, prop_name, '')
+
+
+def _shard_key(name, index):
+	return ndb.Key(CounterShards, '%s#%d' % (name, index))
+
+
+@ndb.tasklet
+def update_async(deltas):
+	"""Adds deltas, a dictionary mapping counter names to amounts, to a random shard of each counter.
+
+	Up to MAX_TRANSACTION_COUNTERS counters are updated per transaction, cross-group when more than one changes;
+	the transactions run concurrently.
+	"""
+	names = [name for name, delta in deltas.iteritems() if delta]
+	yield [_update_shards_async(names[start:start + MAX_TRANSACTION_COUNTERS], deltas)
+	       for start in xrange(0, len(names), MAX_TRANSACTION_COUNTERS)]
+	_update_totals(names, deltas)
+
+
+@ndb.tasklet
+def update_in_transaction_async(deltas):
+	"""Adds deltas as part of the current cross-group transaction, so they only count if it commits.
+
+	Each changed counter takes one of the entity groups the transaction may write to; the cached totals are updated
+	once it commits.
+	"""
+	names = [name for name, delta in deltas.iteritems() if delta]
+	yield _add_to_shards_async(names, deltas)
+	ndb.get_context().call_on_commit(lambda: _update_totals(names, deltas))
+
+
+@ndb.tasklet
+def _add_to_shards_async(names, deltas):
+	keys = [_shard_key(name, random.randrange(config.COUNTER_SHARDS)) for name in names]
+	shards = yield ndb.get_multi_async(keys)
+	for index, name in enumerate(names):
+		shard = shards[index] or CounterShards(key=keys[index], name=name)
+		shard.count += deltas[name]
+		shards[index] = shard
+	yield ndb.put_multi_async(shards)
+
+
+def _update_shards_async(names, deltas):
+	return ndb.transaction_async(lambda: _add_to_shards_async(names, deltas), xg=len(names) > 1)
+
+
+def _update_totals(names, deltas):
+	for name in names:
+		if deltas[name] > 0:
+			memcache.incr(TOTAL_CACHE_PREFIX + name, deltas[name])
+		else:
+			memcache.decr(TOTAL_CACHE_PREFIX + name, -deltas[name])
+
+
+@ndb.tasklet
+def total_async(name):
+	"""Returns the sum of the shards of a counter, from memcache when cached."""
+	cache_key = TOTAL_CACHE_PREFIX + name
+	total = memcache.get(cache_key)
+	if total is None:
+		shards = yield ndb.get_multi_async([_shard_key(name, index) for index in xrange(config.COUNTER_SHARDS)])
+		total = sum(shard.count for shard in shards if shard)
+		memcache.add(cache_key, total, time=config.COUNTER_CACHE_TTL)
+	raise ndb.Return(total)
+
+
+def replace(counts, prefix=None):
+	"""Sets counters to the given values, held in their first shard.
+
+	:param counts: Dictionary mapping counter names to their count.
+	:param prefix: Optional name prefix; the counters with names starting with it which are not in counts are deleted.
+	"""
+	stale_keys = set()
+	if prefix:
+		query = CounterShards.query(CounterShards.name >= prefix, CounterShards.name < prefix + u'\ufffd')
+		stale_keys.update(query.iter(keys_only=True))
+	for name in counts:
+		stale_keys.update(_shard_key(name, index) for index in xrange(1, config.COUNTER_SHARDS))
+	names = set(counts) | set(key.id().rsplit('#', 1)[0] for key in stale_keys)
+
+	shards = [CounterShards(key=_shard_key(name, 0), name=name, count=count) for name, count in counts.iteritems()]
+	stale_keys.difference_update(shard.key for shard in shards)
+	ndb.delete_multi(list(stale_keys))
+	ndb.put_multi(shards)
+	memcache.delete_multi(list(names), key_prefix=TOTAL_CACHE_PREFIX)
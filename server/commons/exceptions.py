@@ -8,3 +8,15 @@ class AuthenticationError(Exception):
 	def __init__(self):
 		self.message = 'Invalid user'
 		self.error_code = 401
+
+
+class AmbiguousFilterError(Exception):
+	def __init__(self):
+		self.message = 'More than one entity matches the filter'
+		self.error_code = 409
+
+
+class ConflictError(Exception):
+	def __init__(self, message):
+		self.message = message or 'The entity already exists'
+		self.error_code = 409
@@ -0,0 +1,113 @@
+"""On-demand profiling of requests.
+
+Requests carrying the PROFILE_HEADER from an App Engine admin, and a random
+sample of config.PROFILE_SAMPLE_RATE of all requests, are run under cProfile.
+The top cumulative entries and the timed spans recorded with span() are kept in
+memcache, where list_profiles() and get_profile() read them back. cProfile and
+pstats are only imported once a request is profiled.
+"""
+import contextlib
+import random
+import threading
+import time
+from google.appengine.api import memcache
+from google.appengine.api import users as gae_users
+from server import config
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+PROFILE_KEY_PREFIX = 'profile:'
+PROFILE_COUNTER_KEY = 'profile-counter'
+PROFILES_LISTED = 20
+PROFILE_TTL = 24 * 60 * 60
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def span(name):
+	"""Times the enclosed block as a named span of the request being profiled, if any."""
+	spans = getattr(_local, 'spans', None)
+	if spans is None:
+		yield
+		return
+	start = time.time()
+	try:
+		yield
+	finally:
+		spans.append((name, (time.time() - start) * 1000))
+
+
+def _should_profile(environ):
+	if environ.get('HTTP_' + PROFILE_HEADER.upper().replace('-', '_')):
+		return gae_users.is_current_user_admin()
+	return config.PROFILE_SAMPLE_RATE and random.random() < config.PROFILE_SAMPLE_RATE
+
+
+def _store(profile_id, environ, profile, duration, spans):
+	import pstats
+	import StringIO
+	output = StringIO.StringIO()
+	profile_stats = pstats.Stats(profile, stream=output)
+	profile_stats.sort_stats('cumulative').print_stats(config.PROFILE_TOP_N)
+	memcache.set(PROFILE_KEY_PREFIX + str(profile_id), {
+		'id': profile_id,
+		'method': environ.get('REQUEST_METHOD'),
+		'path': environ.get('PATH_INFO'),
+		'query': environ.get('QUERY_STRING'),
+		'time': time.time(),
+		'duration_ms': duration * 1000,
+		'spans': spans,
+		'stats': output.getvalue(),
+	}, time=PROFILE_TTL)
+
+
+def list_profiles():
+	"""Returns the latest stored profiles, newest first, without their stats."""
+	last_id = memcache.get(PROFILE_COUNTER_KEY)
+	if not last_id:
+		return []
+	ids = range(last_id, max(last_id - PROFILES_LISTED, 0), -1)
+	profiles = memcache.get_multi([str(profile_id) for profile_id in ids], key_prefix=PROFILE_KEY_PREFIX)
+	return [dict(profiles[str(profile_id)], stats=None) for profile_id in ids if str(profile_id) in profiles]
+
+
+def get_profile(profile_id):
+	return memcache.get(PROFILE_KEY_PREFIX + str(profile_id))
+
+
+class ProfilerMiddleware(object):
+	"""WSGI middleware running the requests selected for profiling under cProfile."""
+
+	def __init__(self, app):
+		self.app = app
+
+	def __call__(self, environ, start_response):
+		if not _should_profile(environ):
+			return self.app(environ, start_response)
+		profile_id = memcache.incr(PROFILE_COUNTER_KEY, initial_value=0)
+		if profile_id is None:
+			return self.app(environ, start_response)
+
+		def profiled_start_response(status, headers, exc_info=None):
+			return start_response(status, headers + [(PROFILE_ID_HEADER, str(profile_id))], exc_info)
+
+		def run():
+			app_iter = self.app(environ, profiled_start_response)
+			try:
+				return list(app_iter)
+			finally:
+				if hasattr(app_iter, 'close'):
+					app_iter.close()
+
+		import cProfile
+		profile = cProfile.Profile()
+		_local.spans = []
+		start = time.time()
+		try:
+			body = profile.runcall(run)
+		finally:
+			duration = time.time() - start
+			spans, _local.spans = _local.spans, None
+		_store(profile_id, environ, profile, duration, spans)
+		return body
@@ -0,0 +1,98 @@
+"""Full-text search of the models declaring _search_fields, backed by the Search API.
+
+Each searchable kind has an index named after it, holding one document per
+entity with a text field for each of the model's _search_fields. Document ids
+are the urlsafe entity keys, so search results are turned back into entities
+with one batched get.
+
+API writes don't update the index themselves: update_later defers a sync of
+the written keys to the task queue, so a Search API error can't fail a write
+that was already stored, and is retried with the task. Drift left by writes
+outside of the API is repaired by the reindex_search job.
+
+The Search API and deferred modules are imported on first use, keeping them
+off the startup path of instances.
+"""
+import logging
+from google.appengine.ext import ndb
+
+# Documents per put and delete call, the Search API maximum (search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST).
+BATCH_SIZE = 200
+# Documents scored for relevance per search, beyond which results are ranked by document rank only.
+SCORED_DOCUMENTS = 1000
+
+
+def get_index(kind):
+	from google.appengine.api import search
+	return search.Index(name=kind)
+
+
+def document(entity):
+	"""Returns the search document of an entity."""
+	from google.appengine.api import search
+	fields = [search.TextField(name=name, value=getattr(entity, name)) for name in entity._search_fields]
+	return search.Document(doc_id=entity.key.urlsafe(), fields=fields)
+
+
+def index(entities):
+	"""Adds or replaces the documents of entities, all of one kind, in its index."""
+	entities = [entity for entity in entities if entity.key is not None]
+	if not entities:
+		return
+	search_index = get_index(entities[0]._get_kind())
+	for start in xrange(0, len(entities), BATCH_SIZE):
+		search_index.put([document(entity) for entity in entities[start:start + BATCH_SIZE]])
+
+
+def unindex(keys):
+	"""Removes the documents of keys, all of one kind, from its index."""
+	keys = list(keys)
+	if not keys:
+		return
+	search_index = get_index(keys[0].kind())
+	for start in xrange(0, len(keys), BATCH_SIZE):
+		search_index.delete([key.urlsafe() for key in keys[start:start + BATCH_SIZE]])
+
+
+def sync(keys):
+	"""Indexes the entities of keys, all of one kind, which exist and removes the documents of the others."""
+	entities = ndb.get_multi(keys)
+	index([entity for entity in entities if entity is not None])
+	unindex([key for key, entity in zip(keys, entities) if entity is None])
+
+
+def update_later(keys):
+	"""Defers a sync of keys, all of one kind; transactionally when called in a transaction.
+
+	Failing to enqueue the task is logged and doesn't fail the write, the reindex_search job repairs the index.
+	"""
+	from google.appengine.ext import deferred
+	keys = [key for key in keys if key is not None]
+	if not keys:
+		return
+	try:
+		deferred.defer(sync, keys, _transactional=ndb.in_transaction())
+	except Exception:
+		logging.exception('Deferring the search index update of %d %s entities failed.', len(keys), keys[0].kind())
+
+
+def search_keys(kind, query_string, limit, cursor=None):
+	"""Returns the keys of the entities matching a search query, most relevant first, and the web-safe cursor of
+	the next page, None on the last page.
+
+	:raises ValueError: if the query string, limit or cursor is not valid.
+	"""
+	from google.appengine.api import search
+	sort_options = search.SortOptions(
+		match_scorer=search.MatchScorer(),
+		expressions=[search.SortExpression(expression='_score', direction=search.SortExpression.DESCENDING,
+		                                   default_value=0)],
+		limit=SCORED_DOCUMENTS)
+	options = search.QueryOptions(limit=limit, ids_only=True, sort_options=sort_options,
+	                              cursor=search.Cursor(web_safe_string=cursor) if cursor else search.Cursor())
+	try:
+		results = get_index(kind).search(search.Query(query_string=query_string, options=options))
+	except (search.QueryError, search.InvalidRequest), e:
+		raise ValueError(str(e))
+	next_cursor = results.cursor.web_safe_string if results.cursor else None
+	return [ndb.Key(urlsafe=result.doc_id) for result in results], next_cursor
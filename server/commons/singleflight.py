@@ -0,0 +1,191 @@
+"""Coalescing of identical concurrent datastore reads within an instance.
+
+When requests served by different threads look up the same key, or run the
+same query, at the same time, the first one (the leader) makes the RPC and
+the others wait for its result instead of making their own. Each thread has
+its own NDB event loop, so followers poll for the result with ndb.sleep,
+letting their other tasklets proceed. They get a copy of each entity, decoded
+from the protocol buffer the leader encodes, because entities are mutable.
+
+A call lives at most WAIT_TIMEOUT seconds: followers stop waiting at its
+deadline and make their own RPC, and an expired call is evicted, so a leader
+whose tasklet is never resumed doesn't hold up later reads of its key. The
+leader also ends its call when its tasklet is closed before finishing.
+
+Keys found missing are remembered for config.SINGLEFLIGHT_NEGATIVE_TTL
+seconds, during which lookups of them return None without an RPC. Puts of
+ModelBase entities forget their key; puts on other instances are only seen
+once the window ends.
+"""
+import threading
+import time
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+from server import config
+from server.commons.cache import LRUCache
+
+NEGATIVE_CACHE_SIZE = 1000
+# Seconds after its start a call is waited for, after which followers make their own RPC and the call is evicted.
+WAIT_TIMEOUT = 5.0
+POLL_INTERVAL = 0.002
+
+_lock = threading.Lock()
+_calls = {}
+_misses = LRUCache(NEGATIVE_CACHE_SIZE, config.SINGLEFLIGHT_NEGATIVE_TTL)
+_adapter = ndb.ModelAdapter()
+
+
+class _Call(object):
+	"""A read in flight, led by the thread that started it."""
+
+	def __init__(self):
+		self.thread = threading.current_thread()
+		self.deadline = time.time() + WAIT_TIMEOUT
+		self.done = threading.Event()
+		self.followers = 0
+		self.failed = False
+		self.value = None
+
+
+def _join(flight_key):
+	"""Returns the call of flight_key and whether the current thread leads it, or (None, False) when the call in
+	flight is led by the current thread, whose own event loop already batches it. An expired call is replaced."""
+	with _lock:
+		call = _calls.get(flight_key)
+		if call is None or time.time() > call.deadline:
+			call = _calls[flight_key] = _Call()
+			return call, True
+		if call.thread is threading.current_thread():
+			return None, False
+		call.followers += 1
+		return call, False
+
+
+def _finish(flight_key, call, value=None, failed=False, export=None):
+	"""Ends a call, handing its value, exported when followers are waiting, over to them."""
+	with _lock:
+		if _calls.get(flight_key) is call:
+			del _calls[flight_key]
+		followers = call.followers
+	if followers and not failed and export:
+		value = export(value)
+	call.value, call.failed = value, failed
+	call.done.set()
+
+
+def _evict(flight_key, call):
+	"""Stops later reads of flight_key from following call, once its deadline passed."""
+	with _lock:
+		if _calls.get(flight_key) is call:
+			del _calls[flight_key]
+
+
+@ndb.tasklet
+def _wait_async(flight_key, call):
+	"""Waits for the leader of call until its deadline, returning whether it succeeded."""
+	while not call.done.is_set():
+		if time.time() > call.deadline:
+			_evict(flight_key, call)
+			raise ndb.Return(False)
+		yield ndb.sleep(POLL_INTERVAL)
+	raise ndb.Return(not call.failed)
+
+
+def _export_entity(entity):
+	return entity and entity._to_pb().Encode()
+
+
+def _import_entity(data):
+	return data and _adapter.pb_to_entity(entity_pb.EntityProto(data))
+
+
+@ndb.tasklet
+def run_async(flight_key, start):
+	"""Returns the result of the tasklet returned by start(), or the result of the call of flight_key in flight in
+	another thread. The result is shared between threads as is, so it must not be mutated."""
+	call, leader = _join(flight_key)
+	if call is not None and not leader:
+		if (yield _wait_async(flight_key, call)):
+			raise ndb.Return(call.value)
+		call = None
+	if call is None:
+		raise ndb.Return((yield start()))
+
+	# The finally clause also runs when the tasklet is closed while waiting, as an abandoned generator is.
+	finished = False
+	try:
+		value = yield start()
+		finished = True
+	finally:
+		_finish(flight_key, call, value if finished else None, failed=not finished)
+	raise ndb.Return(value)
+
+
+@ndb.tasklet
+def get_multi_async(keys, **options):
+	"""Coalesced version of ndb.get_multi_async.
+
+	The keys nobody else is reading are fetched together in one batch. Keys recently found missing are returned as
+	None without a lookup.
+	"""
+	entities = {}
+	leading, following, own = [], [], []
+	for key in keys:
+		if key in entities:
+			continue
+		if _misses.get(key):
+			entities[key] = None
+			continue
+		entities[key] = None
+		flight_key = ('get', key, options.get('read_policy'))
+		call, leader = _join(flight_key)
+		if call is None:
+			own.append(key)
+		elif leader:
+			leading.append((key, flight_key, call))
+		else:
+			following.append((key, flight_key, call))
+
+	own_future = own and ndb.get_multi_async(own, **options)
+	if leading:
+		finished = False
+		try:
+			fetched = yield ndb.get_multi_async([key for key, _, _ in leading], **options)
+			finished = True
+		finally:
+			# Also reached through GeneratorExit when the tasklet is abandoned before the get finishes.
+			if not finished:
+				for _, flight_key, call in leading:
+					_finish(flight_key, call, failed=True)
+		for (key, flight_key, call), entity in zip(leading, fetched):
+			entities[key] = entity
+			if entity is None:
+				_misses.set(key, True)
+			_finish(flight_key, call, entity, export=_export_entity)
+
+	for key, flight_key, call in following:
+		if (yield _wait_async(flight_key, call)):
+			entities[key] = _import_entity(call.value)
+		else:
+			entities[key] = yield key.get_async(**options)
+	if own_future:
+		entities.update(zip(own, (yield own_future)))
+	raise ndb.Return([entities[key] for key in keys])
+
+
+@ndb.tasklet
+def get_async(key, **options):
+	"""Coalesced version of key.get_async."""
+	entities = yield get_multi_async([key], **options)
+	raise ndb.Return(entities[0])
+
+
+def forget(key):
+	"""Drops key from the keys recently found missing, once an entity is stored under it."""
+	_misses.delete(key)
+
+
+def clear():
+	_misses.clear()
+	with _lock:
+		_calls.clear()
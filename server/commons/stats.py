@@ -0,0 +1,211 @@
+"""Per-request datastore and memcache RPC instrumentation.
+
+API proxy hooks count and time every RPC made while a request is served. The
+totals are aggregated per endpoint in memory, from which latency and RPC count
+percentiles are reported.
+
+The entity lookups NDB makes in memcache and the datastore are also counted per
+kind, from which the memcache hit rate of each kind is reported. Lookups served
+by the in-context cache make no RPC and are not counted.
+"""
+import collections
+import threading
+import time
+from flask import request
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+HOOK_NAME = 'request_stats'
+STATS_HEADER = 'X-Request-Stats'
+SAMPLES_PER_ENDPOINT = 1000
+PERCENTILES = (50, 95, 99)
+
+_local = threading.local()
+_lock = threading.Lock()
+_endpoints = {}
+_kinds = collections.defaultdict(collections.Counter)
+
+
+class _RequestStats(object):
+	"""RPC counts and times of the request served by the current thread."""
+
+	def __init__(self):
+		self.start = time.time()
+		self.rpcs = collections.Counter()
+		self.rpc_seconds = 0.0
+		self.pending = {}
+		self.kinds = collections.defaultdict(collections.Counter)
+
+	@property
+	def total_rpcs(self):
+		return sum(self.rpcs.itervalues())
+
+
+class _EndpointStats(object):
+	"""The latest SAMPLES_PER_ENDPOINT latency and RPC count samples of an endpoint."""
+
+	def __init__(self):
+		self.count = 0
+		self.latencies = collections.deque(maxlen=SAMPLES_PER_ENDPOINT)
+		self.rpc_counts = collections.deque(maxlen=SAMPLES_PER_ENDPOINT)
+		self.rpcs = collections.Counter()
+
+	def add(self, latency, request_stats):
+		self.count += 1
+		self.latencies.append(latency)
+		self.rpc_counts.append(request_stats.total_rpcs)
+		self.rpcs.update(request_stats.rpcs)
+
+	def summary(self):
+		return {
+			'requests': self.count,
+			'latency_ms': _percentiles([latency * 1000 for latency in self.latencies]),
+			'rpcs_per_request': _percentiles(list(self.rpc_counts)),
+			'rpcs': dict(self.rpcs),
+		}
+
+
+def _percentiles(samples):
+	if not samples:
+		return {}
+	samples = sorted(samples)
+	last = len(samples) - 1
+	return dict(('p%d' % percentile, samples[int(round(last * percentile / 100.0))]) for percentile in PERCENTILES)
+
+
+def _pre_call_hook(service, call, request_pb, response_pb, rpc=None):
+	current = getattr(_local, 'stats', None)
+	if current is not None:
+		current.pending[id(response_pb)] = time.time()
+
+
+def _post_call_hook(service, call, request_pb, response_pb, rpc=None, error=None):
+	current = getattr(_local, 'stats', None)
+	if current is not None:
+		current.rpcs['%s.%s' % (service, call)] += 1
+		started = current.pending.pop(id(response_pb), None)
+		if started is not None:
+			current.rpc_seconds += time.time() - started
+		if error is None:
+			_count_lookups(current, service, call, request_pb, response_pb)
+
+
+def _memcache_kind(memcache_key):
+	"""Returns the kind of the entity an NDB memcache key is for, or None if it is not an NDB key."""
+	prefix = ndb.Context._memcache_prefix
+	if not memcache_key.startswith(prefix):
+		return None
+	try:
+		return ndb.Key(urlsafe=memcache_key[len(prefix):]).kind()
+	except Exception:
+		return None
+
+
+def _is_ndb_lock(item):
+	return item.flags() == memcache.TYPE_INT and item.value() == str(ndb.context._LOCKED)
+
+
+def _count_lookups(request_stats, service, call, request_pb, response_pb):
+	"""Counts the entity lookups of a memcache or datastore get by kind."""
+	if service == 'memcache' and call == 'Get':
+		# NDB reads back the lock it sets on a miss before storing the entity it fetched; that is no lookup.
+		locks = set(item.key() for item in response_pb.item_list() if _is_ndb_lock(item))
+		for memcache_key in request_pb.key_list():
+			kind = memcache_key not in locks and _memcache_kind(memcache_key)
+			if kind:
+				request_stats.kinds[kind]['memcache_lookups'] += 1
+		for item in response_pb.item_list():
+			kind = item.key() not in locks and _memcache_kind(item.key())
+			if kind:
+				request_stats.kinds[kind]['memcache_hits'] += 1
+	elif service == 'datastore_v3' and call == 'Get':
+		for reference in request_pb.key_list():
+			request_stats.kinds[reference.path().element_list()[-1].type()]['datastore_gets'] += 1
+
+
+def _install_hooks():
+	"""Adds the hooks to the current API proxy, which tests replace for every testbed."""
+	proxy = apiproxy_stub_map.apiproxy
+	if getattr(proxy, HOOK_NAME, False):
+		return
+	with _lock:
+		if not getattr(proxy, HOOK_NAME, False):
+			proxy.GetPreCallHooks().Append(HOOK_NAME, _pre_call_hook)
+			proxy.GetPostCallHooks().Append(HOOK_NAME, _post_call_hook)
+			setattr(proxy, HOOK_NAME, True)
+
+
+def current():
+	"""Returns the stats of the request served by the current thread, or None."""
+	return getattr(_local, 'stats', None)
+
+
+def start_request():
+	_install_hooks()
+	_local.stats = _RequestStats()
+
+
+def finish_request(endpoint):
+	"""Records the stats of the current request under endpoint and returns them."""
+	request_stats = current()
+	_local.stats = None
+	if request_stats is None:
+		return None
+
+	latency = time.time() - request_stats.start
+	with _lock:
+		endpoint_stats = _endpoints.get(endpoint)
+		if endpoint_stats is None:
+			endpoint_stats = _endpoints[endpoint] = _EndpointStats()
+		endpoint_stats.add(latency, request_stats)
+		for kind, counts in request_stats.kinds.iteritems():
+			_kinds[kind].update(counts)
+	request_stats.latency = latency
+	return request_stats
+
+
+def summary():
+	"""Returns the aggregated stats of every endpoint served by this instance."""
+	with _lock:
+		return dict((endpoint, endpoint_stats.summary()) for endpoint, endpoint_stats in _endpoints.iteritems())
+
+
+def kind_summary():
+	"""Returns the memcache lookups, hits and hit rate and the datastore gets of every kind."""
+	with _lock:
+		kinds = dict((kind, dict(counts)) for kind, counts in _kinds.iteritems())
+	for counts in kinds.itervalues():
+		lookups = counts.setdefault('memcache_lookups', 0)
+		counts.setdefault('memcache_hits', 0)
+		counts.setdefault('datastore_gets', 0)
+		counts['memcache_hit_rate'] = float(counts['memcache_hits']) / lookups if lookups else None
+	return kinds
+
+
+def reset():
+	with _lock:
+		_endpoints.clear()
+		_kinds.clear()
+
+
+def init_app(app, header=False):
+	"""Instruments every request of a Flask app.
+
+	:param app: the Flask application.
+	:param header: Boolean; whether responses get an X-Request-Stats header summarizing their RPCs and latency.
+	"""
+
+	@app.before_request
+	def start_request_stats():
+		start_request()
+
+	@app.after_request
+	def finish_request_stats(response):
+		rule = request.url_rule.rule if request.url_rule else 'unmatched'
+		request_stats = finish_request('%s %s' % (request.method, rule))
+		if header and request_stats is not None:
+			response.headers[STATS_HEADER] = 'rpcs=%d; rpc_ms=%.1f; total_ms=%.1f; %s' % (
+				request_stats.total_rpcs, request_stats.rpc_seconds * 1000, request_stats.latency * 1000,
+				', '.join('%s=%d' % item for item in sorted(request_stats.rpcs.iteritems())))
+		return response
@@ -0,0 +1,123 @@
+"""Stateless bearer tokens for the API resources.
+
+A token is the username, a random token id and a fingerprint of the user's
+password hash, signed with the application secret and timestamped by
+itsdangerous. Verifying one needs no datastore access in the common case: the
+signature and age are checked in memory, the token id against the revocation
+list, and the fingerprint against the user read through Users.get_cached, so
+changing the password or deleting the user invalidates its tokens. Revoked tokens are stored in the datastore until they expire,
+and the ids of the unexpired ones are cached in memcache as a single compact
+dictionary of id to expiry.
+"""
+import binascii
+import datetime
+import hashlib
+import hmac
+import os
+import time
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from server import config
+from server.models.revoked_tokens import RevokedTokens
+from server.models.users import Users
+
+TOKEN_SALT = 'api-token'
+BEARER_PREFIX = 'Bearer '
+REVOKED_CACHE_KEY = 'revoked-tokens'
+CAS_RETRIES = 3
+
+_serializer = URLSafeTimedSerializer(config.APP_CONFIG['SECRET_KEY'], salt=TOKEN_SALT)
+
+
+class TokenUser(object):
+	"""The user authenticated by a bearer token, known without loading the Users entity."""
+	is_authenticated = True
+	is_active = True
+	is_anonymous = False
+
+	def __init__(self, username, token_id):
+		self.username = username
+		self.token_id = token_id
+		self.key = ndb.Key('Users', username)
+
+	def get_id(self):
+		return self.username
+
+
+def fingerprint(user):
+	"""Returns a digest of the password hash of user, keyed with the application secret since payloads are readable."""
+	return hmac.new(config.APP_CONFIG['SECRET_KEY'], user.password, hashlib.sha1).hexdigest()[:16]
+
+
+def issue(user):
+	"""Returns a new signed token for user, valid for config.TOKEN_TTL seconds or until its password changes."""
+	return _serializer.dumps({'u': user.username, 'j': binascii.hexlify(os.urandom(8)), 'p': fingerprint(user)})
+
+
+def _load(token):
+	"""Returns the payload and issue time of a token with a valid signature and age, or (None, None)."""
+	try:
+		return _serializer.loads(token, max_age=config.TOKEN_TTL, return_timestamp=True)
+	except BadSignature:
+		return None, None
+
+
+def verify(token):
+	"""Returns the TokenUser of a valid, unrevoked token of an existing user with the same password, or None."""
+	payload, _ = _load(token)
+	if not payload or payload.get('j') in revoked_ids():
+		return None
+	user = Users.get_cached(payload.get('u'))
+	if user is None or not hmac.compare_digest(fingerprint(user), str(payload.get('p', ''))):
+		return None
+	return TokenUser(payload.get('u'), payload.get('j'))
+
+
+def bearer_token(request):
+	header = request.headers.get('Authorization', '')
+	if header.startswith(BEARER_PREFIX):
+		return header[len(BEARER_PREFIX):].strip()
+	return None
+
+
+def revoked_ids():
+	"""Returns a dictionary mapping the ids of the unexpired revoked tokens to their expiry time in seconds."""
+	revoked = memcache.get(REVOKED_CACHE_KEY)
+	if revoked is None:
+		now = datetime.datetime.utcnow()
+		revoked = dict((token.key.id(), _seconds(token.expires))
+		               for token in RevokedTokens.query(RevokedTokens.expires > now))
+		memcache.add(REVOKED_CACHE_KEY, revoked, time=config.REVOKED_TOKENS_CACHE_TTL)
+	return revoked
+
+
+def revoke(token):
+	"""Revokes a valid token until it expires. Returns False if the token is not valid."""
+	payload, issued = _load(token)
+	if not payload:
+		return False
+	token_id = payload.get('j')
+	expires = issued + datetime.timedelta(seconds=config.TOKEN_TTL)
+	RevokedTokens(id=token_id, expires=expires).put()
+
+	# Added to the cached list in place, since a list rebuilt later could miss the new entity while the query is not
+	# yet consistent.
+	revoked_ids()
+	client = memcache.Client()
+	for _ in xrange(CAS_RETRIES):
+		revoked = client.gets(REVOKED_CACHE_KEY)
+		if revoked is None:
+			break
+		now = time.time()
+		revoked = dict((revoked_id, expiry) for revoked_id, expiry in revoked.iteritems() if expiry > now)
+		revoked[token_id] = _seconds(expires)
+		if client.cas(REVOKED_CACHE_KEY, revoked, time=config.REVOKED_TOKENS_CACHE_TTL):
+			break
+	else:
+		memcache.delete(REVOKED_CACHE_KEY)
+	return True
+
+
+def _seconds(value):
+	return (value - datetime.datetime(1970, 1, 1)).total_seconds()
@@ -2,4 +2,37 @@ APP_CONFIG = {
     'DEBUG': True,
     'SECRET_KEY': 'This is supposed to be a secret',
     'WTF_CSRF_SECRET_KEY': 'This is supposed to also be a secret'
-}
\ No newline at end of file
+}
+
+# Cache of users resolved by username for each authenticated request. Writes clear memcache and the cache of the
+# instance making them, the caches of other instances keep serving the old user for up to USER_CACHE_LOCAL_TTL seconds.
+USER_CACHE_SIZE = 1000
+USER_CACHE_LOCAL_TTL = 10
+USER_CACHE_MEMCACHE_TTL = 3600
+# Seconds a reader holds the memcache entry of a user while loading it from the datastore.
+USER_CACHE_LEASE_TTL = 5
+
+# Look users up by username property when no entity is keyed by the username.
+# Disable once server.jobs.migrate_users has rewritten every user.
+USERS_LEGACY_LOOKUP = True
+
+# Seconds collection pages are kept when a query_method enables caching.
+COLLECTION_CACHE_TTL = 60
+
+# Add an X-Request-Stats header with RPC counts and latency to every response.
+REQUEST_STATS_HEADER = False
+
+# Fraction of requests run under cProfile; admins can also send an X-Profile header.
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_TOP_N = 40
+
+# Seconds API bearer tokens stay valid, and seconds the revoked token list is cached in memcache.
+TOKEN_TTL = 24 * 60 * 60
+REVOKED_TOKENS_CACHE_TTL = 60 * 60
+
+# Shards of each counter kept for models declaring _counters, and seconds their totals are cached in memcache.
+COUNTER_SHARDS = 20
+COUNTER_CACHE_TTL = 60
+
+# Seconds a key found missing is remembered by the instance, see server.commons.singleflight.
+SINGLEFLIGHT_NEGATIVE_TTL = 2
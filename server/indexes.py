@@ -0,0 +1,46 @@
+"""Emits the composite indexes needed by the query shapes declared on the models.
+
+Run from the project root with the App Engine SDK on the path:
+
+    python -m server.indexes > index.yaml
+"""
+import sys
+from server.models import tasks, users
+from server.models.model_base import ModelBase
+
+
+def model_classes(base=ModelBase):
+	for subclass in base.__subclasses__():
+		yield subclass
+		for model_class in model_classes(subclass):
+			yield model_class
+
+
+def index_entries():
+	"""Returns sorted (kind, ancestor, properties) tuples, one per distinct composite index."""
+	entries = set()
+	for model_class in model_classes():
+		for shape in model_class._query_shapes:
+			properties = shape.index_properties()
+			if properties:
+				entries.add((model_class._get_kind(), shape.ancestor, tuple(properties)))
+	return sorted(entries)
+
+
+def index_yaml():
+	lines = ['indexes:', '']
+	for kind, ancestor, properties in index_entries():
+		lines.append('- kind: %s' % kind)
+		if ancestor:
+			lines.append('  ancestor: yes')
+		lines.append('  properties:')
+		for name, ascending in properties:
+			lines.append('  - name: %s' % name)
+			if not ascending:
+				lines.append('    direction: desc')
+		lines.append('')
+	return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+	sys.stdout.write(index_yaml())
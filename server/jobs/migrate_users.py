@@ -0,0 +1,88 @@
+"""Rewrites Users entities created before users were keyed by username.
+
+Each run processes one batch of users and defers the next batch with the query
+cursor, so the migration is resumable: a failed batch is retried by the task
+queue from the same cursor, and every step is idempotent. The tasks of a user
+are moved the same way, one batch per run.
+
+Tasks are found with an eventually consistent query on Tasks.owner, so a pass
+can miss tasks written just before it. Old user entities are only deleted by a
+later pass, deferred by CONSISTENCY_DELAY seconds, that finds no more tasks
+to move; a pass that still moves some keeps them and defers another one.
+"""
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+from google.appengine.datastore import datastore_query
+from server.models.users import Users
+from server.models.tasks import Tasks
+
+BATCH_SIZE = 100
+CONSISTENCY_DELAY = 60
+
+
+def is_legacy(user):
+	return user.key.id() != user.username
+
+
+@ndb.transactional
+def _copy_user(user):
+	"""Stores a copy of user keyed by its username, unless one already exists."""
+	new_key = ndb.Key(Users, user.username)
+	if new_key.get() is None:
+		Users(key=new_key, **user.to_dict()).put()
+	return new_key
+
+
+def _move_tasks(old_key, new_key, batch_size, cursor=None):
+	"""Points one batch of the tasks owned by old_key at new_key, and defers the next batch.
+
+	:param cursor: urlsafe cursor to resume the tasks query from.
+	:return: number of tasks moved by this batch.
+	"""
+	start_cursor = datastore_query.Cursor(urlsafe=cursor) if cursor else None
+	tasks, next_cursor, more = Tasks.query(Tasks.owner == old_key).fetch_page(batch_size, start_cursor=start_cursor)
+	for task in tasks:
+		task.owner = new_key
+	ndb.put_multi(tasks)
+	if more and next_cursor:
+		deferred.defer(_move_tasks, old_key, new_key, batch_size, next_cursor.urlsafe())
+	return len(tasks)
+
+
+def migrate_user(user, batch_size=BATCH_SIZE, delete=False):
+	"""Copies user to its new key and moves its tasks.
+
+	:param delete: whether to delete the old entity if no tasks were left to move. When some were, later batches
+				may still be deferred, so the entity is kept for the next pass.
+	:return: True if the old entity was deleted.
+	"""
+	new_key = _copy_user(user)
+	if _move_tasks(user.key, new_key, batch_size) or not delete:
+		return False
+	user.key.delete()
+	Users.invalidate_cached(user.username)
+	return True
+
+
+def migrate_users(cursor=None, batch_size=BATCH_SIZE, delete=False, pending=False):
+	"""Migrates one batch of users and defers the next one.
+
+	:param cursor: urlsafe cursor to resume the users query from.
+	:param batch_size: number of users and tasks written per batch.
+	:param delete: whether this pass deletes the old entities it finds no more tasks for.
+	:param pending: whether an earlier batch of this pass kept an old entity.
+	:return: urlsafe cursor of the next batch, or None when the pass is complete.
+	"""
+	start_cursor = datastore_query.Cursor(urlsafe=cursor) if cursor else None
+	users, next_cursor, more = Users.query().fetch_page(batch_size, start_cursor=start_cursor)
+	for user in users:
+		if is_legacy(user) and not migrate_user(user, batch_size, delete):
+			pending = True
+
+	if more and next_cursor:
+		next_cursor = next_cursor.urlsafe()
+		deferred.defer(migrate_users, next_cursor, batch_size, delete, pending)
+		return next_cursor
+	if pending:
+		deferred.defer(migrate_users, None, batch_size, True, _countdown=CONSISTENCY_DELAY)
+	return None
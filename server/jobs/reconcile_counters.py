@@ -0,0 +1,58 @@
+"""Rebuilds the sharded counters of a model from a scan of its entities.
+
+The kind total is counted with a keys-only query, and each property listed in
+the model's _counters with a projection on that property. Each run scans one
+batch and defers the next with the counts so far. Counters are replaced once
+their scan completes, so writes made during the scan may leave them off by
+those writes; run it when the counters drifted, e.g. after a failed counter
+update or the users migration rewrote Tasks.owner.
+"""
+import collections
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+from google.appengine.datastore import datastore_query
+from server.commons import counters
+
+BATCH_SIZE = 1000
+
+
+def reconcile_counters(kind, prop_name=None, cursor=None, counts=None, batch_size=BATCH_SIZE):
+	"""Counts one batch of entities of kind and defers the next one, moving on to the next counted property when
+	the scan is complete.
+
+	:param kind: kind of the model, which declares _counters.
+	:param prop_name: counted property scanned, None for the kind total.
+	:param cursor: urlsafe cursor to resume the scan from.
+	:param counts: dictionary of the counts so far, by counter name.
+	:param batch_size: number of entities scanned per batch.
+	:return: the (prop_name, cursor) the job continues with, or None when every counter is rebuilt.
+	"""
+	model = ndb.Model._lookup_model(kind)
+	counts = collections.Counter(counts or {})
+	start_cursor = datastore_query.Cursor(urlsafe=cursor) if cursor else None
+	if prop_name is None:
+		keys, next_cursor, more = model.query().fetch_page(batch_size, start_cursor=start_cursor, keys_only=True)
+		counts[counters.counter_name(kind)] += len(keys)
+	else:
+		query = model.query(projection=[prop_name])
+		entities, next_cursor, more = query.fetch_page(batch_size, start_cursor=start_cursor)
+		for entity in entities:
+			counts[counters.counter_name(kind, prop_name, getattr(entity, prop_name))] += 1
+
+	if more and next_cursor:
+		next_step = (prop_name, next_cursor.urlsafe())
+		deferred.defer(reconcile_counters, kind, next_step[0], next_step[1], dict(counts), batch_size)
+		return next_step
+
+	if prop_name is None:
+		counters.replace({counters.counter_name(kind): counts[counters.counter_name(kind)]})
+	else:
+		counters.replace(counts, prefix=counters.group_prefix(kind, prop_name))
+
+	remaining = list(model._counters)
+	if prop_name is not None:
+		remaining = remaining[remaining.index(prop_name) + 1:]
+	if not remaining:
+		return None
+	deferred.defer(reconcile_counters, kind, remaining[0], None, None, batch_size)
+	return remaining[0], None
@@ -0,0 +1,54 @@
+"""Rebuilds the search index of a model declaring _search_fields.
+
+The entities are indexed one batch per run, each run deferring the next with
+the query cursor. Once every entity is indexed, the index is walked in
+document id order and the documents of entities which no longer exist are
+deleted, again one batch per run.
+"""
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+from google.appengine.datastore import datastore_query
+from server.commons import search_index
+
+BATCH_SIZE = search_index.BATCH_SIZE
+
+
+def reindex_search(kind, cursor=None, batch_size=BATCH_SIZE):
+	"""Indexes one batch of entities of kind and defers the next one, or the pruning of the index once done.
+
+	:param kind: kind of the model, which declares _search_fields.
+	:param cursor: urlsafe cursor to resume the entities query from.
+	:param batch_size: number of entities indexed per batch.
+	:return: urlsafe cursor of the next batch, or None when every entity is indexed.
+	"""
+	model = ndb.Model._lookup_model(kind)
+	start_cursor = datastore_query.Cursor(urlsafe=cursor) if cursor else None
+	entities, next_cursor, more = model.query().fetch_page(batch_size, start_cursor=start_cursor)
+	search_index.index(entities)
+
+	if not more or not next_cursor:
+		deferred.defer(prune_search, kind, None, batch_size)
+		return None
+	next_cursor = next_cursor.urlsafe()
+	deferred.defer(reindex_search, kind, next_cursor, batch_size)
+	return next_cursor
+
+
+def prune_search(kind, start_id=None, batch_size=BATCH_SIZE):
+	"""Deletes the documents of missing entities among one batch of documents and defers the next one.
+
+	:param kind: kind of the model, which declares _search_fields.
+	:param start_id: id of the last document of the previous batch.
+	:param batch_size: number of documents checked per batch.
+	:return: id of the last document checked, or None when the whole index is checked.
+	"""
+	documents = search_index.get_index(kind).get_range(start_id=start_id, include_start_object=False,
+	                                                   limit=batch_size, ids_only=True)
+	keys = [ndb.Key(urlsafe=doc.doc_id) for doc in documents]
+	search_index.unindex([key for key, entity in zip(keys, ndb.get_multi(keys)) if entity is None])
+
+	if len(keys) < batch_size:
+		return None
+	last_id = keys[-1].urlsafe()
+	deferred.defer(prune_search, kind, last_id, batch_size)
+	return last_id
@@ -1,14 +1,20 @@
-from time import sleep
-from flask import Flask, request, render_template, url_for, redirect
+from flask import Flask, request, render_template, url_for, redirect, jsonify, abort
+from google.appengine.api import users as gae_users
+from google.appengine.ext import ndb
 from flask_restful import Api
 from flask_login import LoginManager, login_user, login_required, current_user, logout_user
 from models.users import Users
-from config import APP_CONFIG
-from webapp2_extras import security
-from forms import LoginForm
-from forms import RegisterFormExt
+from models.tasks import Tasks
+from config import APP_CONFIG, REQUEST_STATS_HEADER
 from resources.users import UsersResource
-from resources.tasks import TasksResource
+from resources.tasks import TasksResource, TasksBatchResource
+from resources.batch import BatchResource, BATCH_PATH
+from resources.tokens import TokensResource
+from commons import stats
+from commons import tokens
+from commons import profiler
+from models.model_base import ModelBase, query_template_stats
+from models.users import user_cache
 
 app = Flask(__name__)
 app.config.update(APP_CONFIG)
@@ -16,6 +22,8 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please login to access this page.'
+stats.init_app(app, header=REQUEST_STATS_HEADER)
+app.wsgi_app = profiler.ProfilerMiddleware(app.wsgi_app)
 
 
 class MyApi(Api):
@@ -37,7 +45,14 @@ api = MyApi(app)
 
 @login_manager.user_loader
 def user_loader(username):
-	return Users.get_by_username(username)
+	return Users.get_cached(username)
+
+
+@login_manager.request_loader
+def token_loader(request):
+	"""Authenticates requests without a session by their bearer token, if any."""
+	token = tokens.bearer_token(request)
+	return tokens.verify(token) if token else None
 
 
 @app.route('/', methods=['GET'])
@@ -50,26 +65,27 @@ def login():
 	if current_user.is_authenticated:
 		return redirect('dashboard')
 
+	from forms import LoginForm
 	form = LoginForm(csrf_enabled=False)
 	if request.method == 'POST' and form.validate_on_submit():
-		form.user.is_authenticated = True
-		form.user.put()
-		login_user(form.user, remember=form.remember_me.data)
-		sleep(1)
-		return redirect(url_for('dashboard'))
-	else:
-		return render_template('login.html', form=form)
+		user = Users.set_authenticated(form.user.key, True)
+		if user is not None:
+			login_user(user, remember=form.remember_me.data)
+			return redirect(url_for('dashboard'))
+	return render_template('login.html', form=form)
 
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
+	from forms import RegisterFormExt
+	from webapp2_extras import security
 	register_error = None
 	form = RegisterFormExt(csrf_enabled=False)
 	if request.method == 'POST' and form.validate():
 		password = security.generate_password_hash(form.password.data, length=32)
-		user = Users(username=form.username.data, password=password)
-		user.put()
-		return redirect(url_for('login'), code=302)
+		if Users.create(form.username.data, password):
+			return redirect(url_for('login'), code=302)
+		form.username.errors.append('Username has already been registered')
 	return render_template('register.html', form=form, register_error=register_error)
 
 
@@ -82,14 +98,103 @@ def dashboard():
 @app.route('/logout', methods=['GET'])
 @login_required
 def logout():
-	current_user.is_authenticated = False
-	current_user.put()
+	if isinstance(current_user._get_current_object(), tokens.TokenUser):
+		tokens.revoke(tokens.bearer_token(request))
+	else:
+		Users.set_authenticated(current_user.key, False)
 	logout_user()
 	return redirect(url_for('login'))
 
 
+@app.route('/_ah/warmup', methods=['GET'])
+def warmup():
+	"""Loads what the first requests of a new instance would otherwise pay for: the lazily imported form and
+	password hashing modules, the page templates and the JSON codecs of the models."""
+	import forms
+	from webapp2_extras import security
+	for template in ('index.html', 'login.html', 'register.html', 'dashboard.html'):
+		app.jinja_env.get_template(template)
+	for model in (Users, Tasks):
+		model._get_json_codec()
+	return '', 200
+
+
+@app.route('/_stats', methods=['GET'])
+def request_stats():
+	if not gae_users.is_current_user_admin():
+		abort(403)
+	policies = dict((kind, model.cache_policy()) for kind, model in ndb.Model._kind_map.iteritems()
+	                if issubclass(model, ModelBase) and model is not ModelBase)
+	return jsonify(endpoints=stats.summary(), query_templates=query_template_stats(), user_cache=user_cache.stats(),
+	               kinds=stats.kind_summary(), cache_policies=policies)
+
+
+@app.route('/_admin/profiles', methods=['GET'])
+def profiles():
+	if not gae_users.is_current_user_admin():
+		abort(403)
+	return jsonify(data=profiler.list_profiles())
+
+
+@app.route('/_admin/profiles/<int:profile_id>', methods=['GET'])
+def profile(profile_id):
+	if not gae_users.is_current_user_admin():
+		abort(403)
+	stored = profiler.get_profile(profile_id)
+	if stored is None:
+		abort(404)
+	return jsonify(stored)
+
+
+def _lookup_job_model(kind, is_supported):
+	"""Returns the model of kind a job is started for, aborting with 404 if there is none or is_supported(model) is
+	false."""
+	try:
+		model = ndb.Model._lookup_model(kind)
+	except ndb.KindError:
+		abort(404)
+	if not is_supported(model):
+		abort(404)
+	return model
+
+
+@app.route('/_admin/jobs/migrate_users', methods=['POST'])
+def migrate_users():
+	if not gae_users.is_current_user_admin():
+		abort(403)
+	from google.appengine.ext import deferred
+	from jobs.migrate_users import migrate_users as migrate_users_job
+	deferred.defer(migrate_users_job)
+	return 'Users migration started', 202
+
+
+@app.route('/_admin/jobs/reconcile_counters/<kind>', methods=['POST'])
+def reconcile_counters(kind):
+	if not gae_users.is_current_user_admin():
+		abort(403)
+	from google.appengine.ext import deferred
+	from jobs.reconcile_counters import reconcile_counters as reconcile_counters_job
+	_lookup_job_model(kind, lambda model: getattr(model, '_counters', None) is not None)
+	deferred.defer(reconcile_counters_job, kind)
+	return 'Counters reconciliation started', 202
+
+
+@app.route('/_admin/jobs/reindex_search/<kind>', methods=['POST'])
+def reindex_search(kind):
+	if not gae_users.is_current_user_admin():
+		abort(403)
+	from google.appengine.ext import deferred
+	from jobs.reindex_search import reindex_search as reindex_search_job
+	_lookup_job_model(kind, lambda model: getattr(model, '_search_fields', None))
+	deferred.defer(reindex_search_job, kind)
+	return 'Search reindexing started', 202
+
+
 api.add_resource(UsersResource, '/users', '/users/<string:id>')
 api.add_resource(TasksResource, '/tasks', '/tasks/<string:id>')
+api.add_resource(TasksBatchResource, '/tasks:batch')
+api.add_resource(BatchResource, BATCH_PATH)
+api.add_resource(TokensResource, '/tokens')
 
 if __name__ == '__main__':
 	app.run(debug=True)
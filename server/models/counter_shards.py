@@ -0,0 +1,10 @@
+from google.appengine.ext import ndb
+
+
+class CounterShards(ndb.Model):
+	"""One shard of a sharded counter, keyed by the counter name and shard index."""
+	name = ndb.StringProperty(required=True)
+	count = ndb.IntegerProperty(default=0, indexed=False)
+
+	# Counter totals are cached in memcache by server.commons.counters, not the shards.
+	_use_memcache = False
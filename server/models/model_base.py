@@ -1,22 +1,88 @@
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
-from flask import request
+from flask import request, Response, stream_with_context
 from flask_restful import abort
 from flask_login import current_user
-import datetime as main_datetime
+import collections
 import functools
+import hashlib
+import json
+import logging
+import threading
+import time
+from server import config
 from server import utils
 from google.appengine.datastore import datastore_query
 from google.appengine.datastore.datastore_query import datastore_errors
+from google.net.proto import ProtocolBuffer
+from server.commons import counters
 from server.commons import exceptions
+from server.commons import profiler
+from server.commons import search_index
+from server.commons import singleflight
+from server.commons.cache import LRUCache
 
 DEFAULT_FETCH_LIMIT = 10
+MAX_FETCH_LIMIT = 100
+DEFAULT_TRANSFORM_DEPTH = 1
 
 UNIQUE_ID = 'id'
 QUERY_FIELDS = 'query_fields'
 NEXT_PAGE = 'next_page'
+LIMIT = 'limit'
+FIELDS = 'fields'
+KEYS_ONLY = 'keys_only'
+ORDER = 'order'
+ANCESTOR = 'ancestor'
+FORMAT = 'format'
+TOTAL = 'total'
+SEARCH = 'q'
+NDJSON = 'ndjson'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+EXPORT_BATCH_SIZE = 500
+RESERVED_ARGS = (NEXT_PAGE, LIMIT, FIELDS, KEYS_ONLY, ORDER, ANCESTOR, FORMAT, TOTAL, SEARCH)
+FILTER_OPERATOR_SEPARATOR = '__'
+FILTER_OPERATORS = {'eq': '=', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+TRUE_VALUES = ('1', 'true', 'yes')
+FALSE_VALUES = ('0', 'false', 'no')
+STRUCTURED_PROPERTIES = (ndb.StructuredProperty, ndb.LocalStructuredProperty)
+QUERY_TEMPLATE_CACHE_SIZE = 500
+BATCH_CHUNK_SIZE = 500
+MAX_BATCH_ITEMS = 5000
+# Errors caused by a single item of a batch, reported for that item only.
+BATCH_ITEM_ERRORS = (datastore_errors.Error, TypeError, ValueError, ProtocolBuffer.ProtocolBufferDecodeError)
+COLLECTION_CACHE_PREFIX = 'collection:'
+COLLECTION_GENERATION_PREFIX = 'collection-generation:'
 PROPERTY_COLLISION_TEMPLATE = ('Name conflict: %s set as an NDB property and '
                                'an Endpoints alias property.')
 
+query_templates = LRUCache(QUERY_TEMPLATE_CACHE_SIZE)
+_codec_lock = threading.Lock()
+# Keys of the entities put or deleted by the API method running on the thread, see ModelBase.method.
+_write_log = threading.local()
+
+
+def query_template_stats():
+	"""Returns hit, miss and size counters of the query template cache."""
+	return query_templates.stats()
+
+
+def _data_etag(data):
+	"""Return a strong entity tag for JSON serializable data."""
+	return hashlib.sha1(json.dumps(data, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+def _etag_response(output, etag):
+	"""Return a response for output with its ETag header, or 304 if If-None-Match holds the tag."""
+	headers = {'ETag': '"%s"' % etag}
+	if request.if_none_match.contains(etag):
+		return '', 304, headers
+	return output, 200, headers
+
+
+def _batch_error(status, message):
+	return {'status': status, 'message': message}
+
 
 def _verify_property(modelclass, attr_name):
 	"""Return a property if set on a model class, otherwise raises an exception.
@@ -42,6 +108,115 @@ def _verify_property(modelclass, attr_name):
 	return prop
 
 
+def _log_write(key):
+	"""Adds key to the write log of the API method running on the thread, if any."""
+	keys = getattr(_write_log, 'keys', None)
+	if keys is not None:
+		keys.add(key)
+
+
+def _read_options(kind):
+	"""Returns the keyword arguments applying the _read_policy of the model of kind to gets and queries."""
+	read_policy = getattr(ndb.Model._kind_map.get(kind), '_read_policy', None)
+	return {'read_policy': read_policy} if read_policy is not None else {}
+
+
+@ndb.tasklet
+def _get_multi_async(keys):
+	"""Coalesced tasklet version of ndb.get_multi honoring the read policy of each kind; keys of kinds sharing a
+	policy are fetched together."""
+	groups = collections.defaultdict(list)
+	for key in keys:
+		groups[_read_options(key.kind()).get('read_policy')].append(key)
+	futures = [(group, singleflight.get_multi_async(group, **({'read_policy': read_policy}
+	                                                          if read_policy is not None else {})))
+	           for read_policy, group in groups.iteritems()]
+	entities = {}
+	for group, future in futures:
+		entities.update(zip(group, (yield future)))
+	raise ndb.Return([entities[key] for key in keys])
+
+
+def _parse_order(order):
+	"""Return (name, ascending) pairs from a comma separated order string.
+
+  Args:
+    order: String; property names, each optionally preceded by a minus sign
+        for descending order. May be None.
+  """
+	if not order:
+		return ()
+
+	result = []
+	for attr_name in order.strip().split(','):
+		attr_name = attr_name.strip()
+		if attr_name.startswith('-'):
+			result.append((attr_name[1:], False))
+		else:
+			result.append((attr_name, True))
+	return tuple(result)
+
+
+class QueryShape(object):
+	"""The filter, order, ancestor and projection structure of a query, without its values.
+
+Models list the shapes their API serves in _query_shapes, from which the
+composite indexes in index.yaml are generated (see server.indexes).
+
+Attributes:
+  filters: A sorted tuple of equality filtered property names.
+  inequality: Name of the range filtered property, or None.
+  orders: A tuple of (name, ascending) pairs.
+  ancestor: Boolean; whether the query has an ancestor.
+  projection: A sorted tuple of projected property names, empty unless the
+      query is a projection query.
+"""
+
+	def __init__(self, filters=(), inequality=None, order=None, ancestor=False, projection=()):
+		self.filters = tuple(sorted(filters))
+		self.inequality = inequality
+		self.orders = _parse_order(order)
+		self.ancestor = ancestor
+		self.projection = tuple(sorted(projection))
+
+	def _tuple(self):
+		return self.filters, self.inequality, self.orders, self.ancestor, self.projection
+
+	def __eq__(self, other):
+		return isinstance(other, QueryShape) and self._tuple() == other._tuple()
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash(self._tuple())
+
+	def __repr__(self):
+		return 'QueryShape(filters=%r, inequality=%r, orders=%r, ancestor=%r, projection=%r)' % self._tuple()
+
+	def index_properties(self):
+		"""Return the (name, ascending) pairs of the composite index serving the shape.
+
+    Returns None when the built-in indexes serve the shape: kind and ancestor
+    only queries, equality only queries, and queries on a single property.
+    Projected properties the filters and orders don't cover follow the orders,
+    since a projection query reads its values from the index.
+    """
+		orders = list(self.orders)
+		if self.inequality and (not orders or orders[0][0] != self.inequality):
+			orders.insert(0, (self.inequality, True))
+		orders = [order for order in orders if order[0] not in self.filters]
+		ordered = set(name for name, _ in orders)
+		orders.extend((name, True) for name in self.projection if name not in self.filters and name not in ordered)
+		if not orders:
+			return None
+
+		properties = [(name, True) for name in self.filters] + orders
+		if not self.ancestor and len(properties) == 1:
+			return None
+		return properties
+
+
 # Code adapted from endpoints_proto_datastore lib.
 class _EndpointsQueryInfo(object):
 	"""A custom container for query information.
@@ -59,6 +234,8 @@ Attributes:
       will be used to create filters for a query.
   _filters: A set of simple equality filters (ndb.FilterNode). Utilizes the
       fact that FilterNodes are hashable and respect equality.
+  _comparisons: A dictionary mapping the filters added by _AddComparison to
+      (name, opsymbol, property, value) tuples, used to bind query templates.
   _ancestor: An ndb Key to be used as an ancestor for a query.
   _cursor: A datastore_query.Cursor, to be used for resuming a query.
   _limit: A positive integer, to be used in a fetch.
@@ -67,6 +244,9 @@ Attributes:
   _order_attrs: The attributes (or negation of attributes) parsed from
       _order. If these can't be parsed from the attributes in _entity, will
       throw an exception.
+  _order_names: A tuple of (name, ascending) pairs parsed from _order.
+  _projection: A tuple of property names, used to make a projection query.
+  _keys_only: Boolean; whether the query should only return keys.
   _query_final: A final query created using the orders (_order_attrs), filters
       (_filters) and class definition (_entity) in the query info. If this is
       not null, setting attributes on the query info object will fail.
@@ -88,19 +268,23 @@ Raises:
 		self._entity = entity
 
 		self._filters = set()
+		self._comparisons = {}
 		self._ancestor = None
 		self._cursor = None
 		self._limit = None
 		self._order = None
 		self._order_attrs = ()
+		self._order_names = ()
+		self._projection = None
+		self._keys_only = False
 
 		self._query_final = None
 
 	def _PopulateFilters(self):
 		"""Populates filters in query info by using values set on the entity."""
 		entity = self._entity
-		for prop in entity._properties.itervalues():
-			current_value = prop._retrieve_value(entity)
+		for name, current_value in entity._values.iteritems():
+			prop = entity._properties[name]
 
 			if prop._repeated:
 				if current_value is not None:
@@ -109,18 +293,28 @@ Raises:
 
 			# Only filter for non-null values
 			if current_value is not None:
-				self._AddFilter(prop == current_value)
+				self._AddComparison(prop, '=', current_value)
 
 	def SetQuery(self):
 		"""Sets the final query on the query info object.
 
 Uses the filters and orders in the query info to refine the query. If the
 final query is already set, does nothing.
+
+When every filter was added with its value (see _AddComparison), the query is
+bound from a template cached per filter, order and ancestor shape instead of
+being built filter by filter.
 """
 		if self._query_final is not None:
 			return
 
 		self._PopulateFilters()
+		self._CheckInequality()
+		self._CheckProjection()
+
+		if len(self._comparisons) == len(self._filters):
+			self._query_final = self._BindTemplate()
+			return
 
 		# _entity.query calls the classmethod for the entity
 		if self.ancestor is not None:
@@ -135,6 +329,42 @@ final query is already set, does nothing.
 
 		self._query_final = query
 
+	def _BindTemplate(self):
+		"""Returns the query bound from the cached template for its shape."""
+		comparisons = sorted(self._comparisons.itervalues(), key=lambda comparison: comparison[:2])
+		ancestor_kind = self._ancestor.kind() if self._ancestor is not None else None
+		template_key = (self._entity._get_kind(), tuple(comparison[:2] for comparison in comparisons),
+		                self._order_names, ancestor_kind)
+
+		template = query_templates.get(template_key)
+		if template is None:
+			template = self._BuildTemplate(comparisons)
+			query_templates.set(template_key, template)
+
+		values = [comparison[3] for comparison in comparisons]
+		if self._ancestor is not None:
+			values.append(self._ancestor)
+		return template.bind(*values)
+
+	def _BuildTemplate(self, comparisons):
+		"""Returns a query with a positional ndb.Parameter for each comparison value and the ancestor."""
+		# ParameterNode, as NDB's GQL builds them: a comparison node would validate the Parameter as a value.
+		filters = [ndb.query.ParameterNode(prop, opsymbol, ndb.Parameter(position))
+		           for position, (_, opsymbol, prop, _) in enumerate(comparisons, 1)]
+		ancestor = None
+		if self._ancestor is not None:
+			ancestor = ndb.Parameter(len(filters) + 1)
+		query = self._entity.query(*filters, ancestor=ancestor)
+		if self._order_attrs:
+			query = query.order(*self._order_attrs)
+		return query
+
+	def _AddComparison(self, prop, opsymbol, value):
+		"""Adds the filter comparing prop with value, remembering the value for template binding."""
+		candidate_filter = prop._comparison(opsymbol, value)
+		self._AddFilter(candidate_filter)
+		self._comparisons[candidate_filter] = (prop._name, opsymbol, prop, value)
+
 	def _AddFilter(self, candidate_filter):
 		"""Checks a filter and sets it in the filter set.
 
@@ -144,7 +374,8 @@ Args:
 Raises:
   AttributeError: if query on the object is already final.
   TypeError: if the filter is not a simple filter (FilterNode).
-  ValueError: if the operator symbol in the filter is not equality.
+  ValueError: if the operator symbol in the filter is not equality or a range
+      comparison.
 """
 		if self._query_final is not None:
 			raise AttributeError('Can\'t add more filters. Query info is final.')
@@ -153,17 +384,103 @@ Raises:
 			raise TypeError('Only simple filters can be used. Received: %s.' %
 			                (candidate_filter,))
 		opsymbol = candidate_filter._FilterNode__opsymbol
-		if opsymbol != '=':
-			raise ValueError('Only equality filters allowed. Received: %s.' %
+		if opsymbol not in FILTER_OPERATORS.values():
+			raise ValueError('Only equality and range filters allowed. Received: %s.' %
 			                 (opsymbol,))
 
 		self._filters.add(candidate_filter)
 
+	def AddPropertyFilter(self, attr_name, opsymbol, value):
+		"""Adds a filter comparing a property of the entity with a JSON value.
+
+Args:
+  attr_name: String; the name of the property.
+  opsymbol: String; one of the operator symbols in FILTER_OPERATORS.
+  value: The query string value to compare with, decoded with the entity JSON
+      codec.
+
+Raises:
+  AttributeError: if the property is not set on the entity class.
+  BadValueError: if the value is not valid for the property.
+"""
+		prop = _verify_property(self._entity, attr_name)
+		value = self._entity._get_json_codec().decode_string(attr_name, value)
+		self._AddComparison(prop, opsymbol, value)
+
+	def _CheckInequality(self):
+		"""Verifies the filters and order respect datastore inequality rules.
+
+Raises:
+  ValueError: if range filters are set on more than one property, or the
+      first order is not on the range filtered property.
+"""
+		names = set(query_filter._FilterNode__name for query_filter in self._filters
+		            if query_filter._FilterNode__opsymbol != '=')
+		if len(names) > 1:
+			raise ValueError('Range filters are limited to one property. Received: %s.' %
+			                 (', '.join(sorted(names)),))
+		if names and self._order_names and self._order_names[0][0] not in names:
+			raise ValueError('The first order must be on the range filtered property %s.' %
+			                 (names.pop(),))
+
+	def _CheckProjection(self):
+		"""Verifies no projected property is also equality filtered, which the datastore rejects at fetch time.
+
+Raises:
+  ValueError: if a projected property has an equality filter.
+"""
+		if self._keys_only or not self._projection:
+			return
+		names = set(query_filter._FilterNode__name for query_filter in self._filters
+		            if query_filter._FilterNode__opsymbol == '=')
+		filtered = [name for name in self._projection if name in names]
+		if filtered:
+			raise ValueError('Equality filtered properties can\'t be projected. Received: %s.' %
+			                 (', '.join(filtered),))
+
+	@property
+	def equality_values(self):
+		"""A dictionary of the values of the equality filtered properties, or None unless the query has only
+		equality filters, at most one per property, and no ancestor."""
+		if self._ancestor is not None or len(self._comparisons) != len(self._filters):
+			return None
+		values = {}
+		for name, opsymbol, _, value in self._comparisons.itervalues():
+			if opsymbol != '=' or name in values:
+				return None
+			values[name] = value
+		return values
+
+	@property
+	def shape(self):
+		"""The QueryShape of the query, from the filters, order, ancestor and projection set."""
+		equality = []
+		inequality = None
+		for query_filter in self._filters:
+			if query_filter._FilterNode__opsymbol == '=':
+				equality.append(query_filter._FilterNode__name)
+			else:
+				inequality = query_filter._FilterNode__name
+		return QueryShape(filters=equality, inequality=inequality, order=self._order,
+		                  ancestor=self._ancestor is not None,
+		                  projection=() if self._keys_only else self._projection or ())
+
 	@property
 	def query(self):
 		"""Public getter for the final query on query info."""
 		return self._query_final
 
+	@property
+	def fetch_options(self):
+		"""Keyword arguments for fetching the final query with the query info settings."""
+		options = {'start_cursor': self._cursor}
+		options.update(self._entity._read_options())
+		if self._keys_only:
+			options['keys_only'] = True
+		elif self._projection:
+			options['projection'] = self._projection
+		return options
+
 	def _GetAncestor(self):
 		"""Getter to be used for public ancestor property on query info."""
 		return self._ancestor
@@ -264,14 +581,9 @@ Raises:
 		if self._order is None:
 			return
 
-		unclean_attr_names = self._order.strip().split(',')
 		result = []
-		for attr_name in unclean_attr_names:
-			ascending = True
-			if attr_name.startswith('-'):
-				ascending = False
-				attr_name = attr_name[1:]
-
+		names = []
+		for attr_name, ascending in _parse_order(self._order):
 			attr = self._entity._properties.get(attr_name)
 			if attr is None:
 				raise AttributeError('Order attribute %s not defined.' % (attr_name,))
@@ -280,8 +592,10 @@ Raises:
 				result.append(+attr)
 			else:
 				result.append(-attr)
+			names.append((attr_name, ascending))
 
 		self._order_attrs = tuple(result)
+		self._order_names = tuple(names)
 
 	def _SetOrder(self, value):
 		"""Setter to be used for public order property on query info.
@@ -317,19 +631,279 @@ Raises:
 
 	order = property(fget=_GetOrder, fset=_SetOrder)
 
+	def _GetProjection(self):
+		"""Getter to be used for public projection property on query info."""
+		return self._projection
+
+	def _SetProjection(self, value):
+		"""Setter to be used for public projection property on query info.
+
+    Args:
+      value: String; comma separated list of property names. The unique id is
+          always returned, so it is accepted and left out of the projection;
+          when it is the only name, the query is made keys only.
+
+    Raises:
+      AttributeError: if query on the object is already final.
+      AttributeError: if the projection has already been set.
+      AttributeError: if one of the names is not a property on the entity.
+      TypeError: if the projection to be set is not a string.
+    """
+		if self._query_final is not None:
+			raise AttributeError('Can\'t set projection. Query info is final.')
+
+		if self._projection is not None:
+			raise AttributeError('Projection can\'t be set twice.')
+		if not isinstance(value, basestring):
+			raise TypeError('Projection must be a string.')
+
+		result = []
+		unique_id = False
+		for attr_name in value.strip().split(','):
+			attr_name = attr_name.strip()
+			if attr_name == UNIQUE_ID:
+				unique_id = True
+			if not attr_name or attr_name == UNIQUE_ID:
+				continue
+			_verify_property(self._entity, attr_name)
+			result.append(attr_name)
+		self._projection = tuple(result)
+		if unique_id and not result:
+			self._keys_only = True
+
+	projection = property(fget=_GetProjection, fset=_SetProjection)
+
+	def _GetKeysOnly(self):
+		"""Getter to be used for public keys_only property on query info."""
+		return self._keys_only
+
+	def _SetKeysOnly(self, value):
+		"""Setter to be used for public keys_only property on query info.
+
+    Raises:
+      AttributeError: if query on the object is already final.
+      TypeError: if the value to be set is not a boolean.
+    """
+		if self._query_final is not None:
+			raise AttributeError('Can\'t set keys_only. Query info is final.')
+		if not isinstance(value, bool):
+			raise TypeError('Keys only must be a boolean.')
+		self._keys_only = value
+
+	keys_only = property(fget=_GetKeysOnly, fset=_SetKeysOnly)
+
+
+class _JsonCodec(object):
+	"""JSON encoders and decoders for the properties of a model class.
+
+Built once per model class by ModelBase._get_json_codec, so that serializing an
+entity is a single pass over prebuilt (property, encoder) pairs instead of type
+checks against every value.
+
+Attributes:
+  _encoders: A tuple of (name, property, encoder, is_key) tuples. The encoder is
+      None when the property value can be returned as is.
+  _decoders: A dictionary mapping property names to functions converting JSON
+      values to property values.
+  _string_decoders: A dictionary mapping the names of boolean and numeric
+      properties to functions converting strings, such as query string
+      values, to JSON values of the property type.
+  version_property: The first auto_now property of the model, updated by every
+      put, or None.
+"""
+
+	def __init__(self, modelclass):
+		"""Compiles encoders and decoders for every property of modelclass.
+
+Args:
+  modelclass: A subclass of ndb.Model.
+"""
+		encoders = []
+		self._decoders = {}
+		self._string_decoders = {}
+		self.version_property = None
+		for prop in modelclass._properties.itervalues():
+			name = prop._code_name
+			encoder, decoder = self._compile_property(prop)
+			if prop._repeated:
+				decoder = self._repeated_decoder(decoder)
+			encoders.append((name, prop, encoder, isinstance(prop, ndb.KeyProperty)))
+			if self.version_property is None and getattr(prop, '_auto_now', False):
+				self.version_property = prop
+			self._decoders[name] = decoder
+			string_decoder = self._compile_string_decoder(prop)
+			if string_decoder is not None:
+				self._string_decoders[name] = string_decoder
+		self._encoders = tuple(encoders)
+
+	@staticmethod
+	def _repeated_decoder(decoder):
+		"""Returns a decoder applying decoder to every item of a list."""
+		return lambda values: [decoder(value) for value in values]
+
+	@staticmethod
+	def _compile_property(prop):
+		"""Returns an (encoder, decoder) pair for a single property."""
+		if isinstance(prop, ndb.DateTimeProperty):
+			return utils.date_encoder(prop), utils.date_decoder(prop)
+		elif isinstance(prop, ndb.KeyProperty):
+			return ndb.Key.urlsafe, lambda value: ndb.Key(urlsafe=value)
+		elif isinstance(prop, STRUCTURED_PROPERTIES) and issubclass(prop._modelclass, ModelBase):
+			modelclass = prop._modelclass
+
+			def decode_structured(value):
+				entity = modelclass()
+				entity.from_json(value)
+				return entity
+
+			return lambda value: value._get_json_codec().encode(value), decode_structured
+		elif isinstance(prop, STRUCTURED_PROPERTIES):
+			return lambda value: value._to_dict(), lambda value: value
+		return None, lambda value: value
+
+	@staticmethod
+	def _compile_string_decoder(prop):
+		"""Returns a function converting a string to a JSON value of the property type, or None when strings are
+		already JSON values of the property."""
+		if isinstance(prop, ndb.BooleanProperty):
+			def decode_boolean(value):
+				if value.lower() in TRUE_VALUES:
+					return True
+				if value.lower() in FALSE_VALUES:
+					return False
+				raise ValueError('Expected a boolean for %s, received %r.' % (prop._code_name, value))
+
+			return decode_boolean
+		elif isinstance(prop, ndb.IntegerProperty):
+			return int
+		elif isinstance(prop, ndb.FloatProperty):
+			return float
+		return None
+
+	def encode(self, entity, key_encoder=None):
+		"""Returns a dictionary of JSON serializable property values of entity.
+
+Args:
+  entity: An instance of the model class the codec was compiled for.
+  key_encoder: An optional function used instead of the default encoder for
+      ndb.Key values.
+"""
+		data = {}
+		for name, prop, encoder, is_key in self._encoders:
+			try:
+				value = prop._get_value(entity)
+			except ndb.UnprojectedPropertyError:
+				continue
+
+			if is_key and key_encoder is not None:
+				encoder = key_encoder
+			if value is None or encoder is None:
+				data[name] = value
+			elif prop._repeated:
+				data[name] = [encoder(item) for item in value]
+			else:
+				data[name] = encoder(value)
+		return data
+
+	def decode_value(self, name, value):
+		"""Returns the property value of a JSON value for the property name."""
+		decoder = self._decoders.get(name)
+		if decoder is None or value is None:
+			return value
+		return decoder(value)
+
+	def decode_string(self, name, value):
+		"""Returns the property value of a string for the property name, such as a query string or URL value."""
+		string_decoder = self._string_decoders.get(name)
+		if string_decoder is not None and isinstance(value, basestring):
+			value = string_decoder(value)
+		return self.decode_value(name, value)
+
+	def decode(self, entity, request_data):
+		"""Sets the values in request_data on entity, ignoring unknown fields."""
+		decoders = self._decoders
+		for name, value in request_data.iteritems():
+			decoder = decoders.get(name)
+			if decoder is not None:
+				if value is not None:
+					value = decoder(value)
+				setattr(entity, name, value)
+
 
 class ModelBase(ndb.Model):
 	_alias_properties = None
-
-	def __init__(self, *args, **kwargs):
-		super(ModelBase, self).__init__(*args, **kwargs)
-		self._endpoints_query_info = _EndpointsQueryInfo(self)
-		self._from_datastore = False
+	_max_fetch_limit = MAX_FETCH_LIMIT
+	_query_shapes = ()
+	# Caching policy of the kind. NDB reads _use_cache (in-context cache), _use_memcache and _memcache_timeout from
+	# the model class, None keeping its default. _read_policy is passed to the gets and queries of the decorators
+	# and lookup helpers: ndb.EVENTUAL_CONSISTENCY, or None for strongly consistent reads.
+	_use_cache = None
+	_use_memcache = None
+	_memcache_timeout = None
+	_read_policy = None
+	# Names of the properties entities are counted by, besides the kind total; None when the model is not counted.
+	_counters = None
+	# Names of the string properties indexed for full-text search, see server.commons.search_index.
+	_search_fields = ()
+	# Whether a query_method of the model caches collection pages, set by query_method(cache=True); only then do
+	# writes bump the collection generation.
+	_collection_cache = False
+
+	# Instance attributes default to these class attributes, so entities
+	# materialized by NDB pay nothing for them until they are set.
+	_from_datastore = False
+	_query_info = None
+	# Counter names of the entity as read from the datastore, see _counter_names.
+	_stored_counters = ()
 
 	@property
 	def from_datastore(self):
 		return self._from_datastore
 
+	@property
+	def _endpoints_query_info(self):
+		"""The query info of the entity, created on first access."""
+		if self._query_info is None:
+			self._query_info = _EndpointsQueryInfo(self)
+		return self._query_info
+
+	def _post_put_hook(self, future):
+		if not future.get_exception():
+			singleflight.forget(future.get_result())
+			_log_write(future.get_result())
+
+	@classmethod
+	def _post_delete_hook(cls, key, future):
+		if not future.get_exception():
+			_log_write(key)
+
+	@classmethod
+	def _read_options(cls):
+		"""Returns the keyword arguments applying the read policy of the class to gets and queries."""
+		return _read_options(cls._get_kind())
+
+	@classmethod
+	def cache_policy(cls):
+		"""Returns the declared caching policy of the class, None values meaning the NDB default."""
+		return {
+			'use_cache': cls._use_cache,
+			'use_memcache': cls._use_memcache,
+			'memcache_timeout': cls._memcache_timeout,
+			'read_policy': 'eventual' if cls._read_policy == ndb.EVENTUAL_CONSISTENCY else 'strong',
+		}
+
+	@classmethod
+	def _get_json_codec(cls):
+		"""Returns the JSON codec of the class, compiling it on first use."""
+		codec = cls.__dict__.get('_json_codec')
+		if codec is None:
+			with _codec_lock:
+				codec = cls.__dict__.get('_json_codec')
+				if codec is None:
+					codec = _JsonCodec(cls)
+					cls._json_codec = codec
+		return codec
+
 	@classmethod
 	def _GetEndpointsProperty(cls, attr_name):
 		"""Return a property if set on a model class.
@@ -346,34 +920,52 @@ class ModelBase(ndb.Model):
 
 	@classmethod
 	def from_filter_data(cls, filter_data):
+		return cls.from_filter_data_async(filter_data).get_result()
+
+	@classmethod
+	@ndb.tasklet
+	def from_filter_data_async(cls, filter_data):
+		"""
+		Looks up the single entity matching filter data.
+
+		With an id the entity is read with one get and the other fields are checked on it. Without one, the field
+		predicates are pushed into a keys-only query fetching at most two keys, followed by a single get, so the
+		cost does not grow with the number of entities matching.
+		:param filter_data: Dictionary of field names and values, id being the urlsafe entity key.
+		:return: The matching entity, or None.
+		:raises AmbiguousFilterError: if more than one entity matches a filter without id.
+		"""
+		codec = cls._get_json_codec()
 		url_string = filter_data.get(UNIQUE_ID)
 		if url_string:
 			entity_key = ndb.Key(urlsafe=url_string)
 
 			if entity_key:
+				if entity_key.kind() != cls._get_kind():
+					abort(400, message='The id is not the key of a %s entity.' % cls._get_kind())
 				filter_data.pop(UNIQUE_ID)
-				entity = entity_key.get()
+				entity = yield singleflight.get_async(entity_key, **_read_options(entity_key.kind()))
+				if entity is None:
+					raise ndb.Return(None)
 				for field_name, value in filter_data.iteritems():
-					if getattr(entity, field_name) != value:
-						return None
-				return entity
+					if getattr(entity, field_name) != codec.decode_string(field_name, value):
+						raise ndb.Return(None)
+				raise ndb.Return(entity)
 			else:
-				return None
+				raise ndb.Return(None)
 		else:
 			entity_query = cls.query()
 			for field_name, value in filter_data.iteritems():
 				value_property = _verify_property(cls, field_name)
-				entity_query = entity_query.filter(value_property == value)
-			return entity_query.fetch()
-
-	@staticmethod
-	def to_json_data(value):
-		property_value = value
-		if isinstance(value, (main_datetime.date, main_datetime.datetime, main_datetime.time)):
-			property_value = utils.date_to_str(value)
-		elif isinstance(value, ndb.Key):
-			property_value = value.urlsafe()
-		return property_value
+				entity_query = entity_query.filter(value_property == codec.decode_string(field_name, value))
+			read_options = cls._read_options()
+			flight_key = ('query', repr(entity_query), read_options.get('read_policy'))
+			keys = yield singleflight.run_async(flight_key,
+			                                    lambda: entity_query.fetch_async(2, keys_only=True, **read_options))
+			if len(keys) > 1:
+				raise exceptions.AmbiguousFilterError
+			entity = keys and (yield singleflight.get_async(keys[0], **read_options))
+			raise ndb.Return(entity or None)
 
 	def to_json(self):
 		"""
@@ -382,16 +974,25 @@ class ModelBase(ndb.Model):
 		Watch for data that cannot be serialized by jsonify function, then convert data into an acceptable format.
 		:return: Dictionary containing entity data.
 		"""
-		data = self._to_dict()
-		for property, value in data.iteritems():
-			if isinstance(value, ModelBase):
-				property_value = value.to_json()
-			else:
-				property_value = self.to_json_data(value)
-			data[property] = property_value
-		data.update({'id': self.key.urlsafe()})
+		data = self._get_json_codec().encode(self)
+		data['id'] = self.key.urlsafe()
 		return data
 
+	def etag(self):
+		"""
+		Strong validator of the entity's own property values.
+
+		Built from the key and auto_now timestamp when the model has an auto_now property, so it is known without
+		serializing the entity, otherwise from a hash of to_json.
+		:return: String; the entity tag, unquoted.
+		"""
+		version_property = self._get_json_codec().version_property
+		if version_property is not None:
+			version = version_property._get_value(self)
+			if version is not None:
+				return hashlib.sha1('%s:%s' % (self.key.urlsafe(), version.isoformat())).hexdigest()
+		return _data_etag(self.to_json())
+
 	@classmethod
 	def to_json_collection(cls, items, next_cursor=None):
 		output = {NEXT_PAGE: next_cursor, 'data': []}
@@ -399,6 +1000,10 @@ class ModelBase(ndb.Model):
 			output['data'].append(item.to_json())
 		return output
 
+	@staticmethod
+	def keys_to_json_collection(keys, next_cursor=None):
+		return {NEXT_PAGE: next_cursor, 'data': [{UNIQUE_ID: key.urlsafe()} for key in keys]}
+
 	def from_json(self, request_data):
 		"""
 		Update entity with new data from json.
@@ -407,18 +1012,11 @@ class ModelBase(ndb.Model):
 		:param request_data:
 		:return:
 		"""
-		for property, value in request_data.iteritems():
-			prop_type = self._properties.get(property)
-			if prop_type:
-				prop_value = value
-				if isinstance(prop_type, (ndb.DateProperty, ndb.DateTimeProperty, ndb.TimeProperty)):
-					prop_value = utils.date_from_str(prop_type, prop_value)
-				elif isinstance(prop_type, ndb.KeyProperty):
-					prop_value = ndb.Key(urlsafe=prop_value)
-				setattr(self, property, prop_value)
+		self._get_json_codec().decode(self, request_data)
 
 	@classmethod
-	def method(cls, transform_response=False, transform_fields=None, user_required=False):
+	def method(cls, transform_response=False, transform_fields=None, user_required=False,
+	           transform_depth=DEFAULT_TRANSFORM_DEPTH):
 		"""Creates an API method decorator.
     :param transform_request: Boolean; indicates whether or not
         a response data's ndb.Key value are to be returned,
@@ -427,117 +1025,675 @@ class ModelBase(ndb.Model):
     :param transform_fields: An (optional) list or tuple that defines
         returned fields for ndb.Key value type in response data.
     :param user_required: Boolean; indicates whether or not a user is required on any incoming request.
-    :return: A decorator that takes the metadata passed in and augments an API method.
+    :param transform_depth: Integer; number of levels of ndb.Key values resolved when transform_response is True.
+    :return: A decorator that takes the metadata passed in and augments an API method. The API method may be
+        a tasklet; datastore work of the decorator is done with async calls so it can overlap with it.
     """
 
 		def request_to_entity_decorator(api_method):
-			@functools.wraps(api_method)
-			def entity_to_request_method(service_instance, **filter_data):
+			@ndb.tasklet
+			def entity_request_async(service_instance, filter_data):
 				if user_required and not current_user.is_authenticated:
 					raise exceptions.AuthenticationError
+				entity_future = filter_data and cls.from_filter_data_async(filter_data)
 
 				entity = None
-				if filter_data:
-					entity = cls.from_filter_data(filter_data)
+				if entity_future:
+					with profiler.span('filter_lookup'):
+						entity = yield entity_future
 					if entity:
-						if type(entity) is list:
-							entity = entity[0]
 						entity._from_datastore = True
+						entity._stored_counters = entity._counter_names()
 
 				if not entity:
 					entity = cls()
 
-				request_data = request.get_json()
-				request_data and entity.from_json(request_data)
+				@ndb.tasklet
+				def apply_request_async(entity):
+					with profiler.span('from_json'):
+						request_data = request.get_json()
+						request_data and entity.from_json(request_data)
+
+					try:
+						with profiler.span('handler'):
+							response = api_method(service_instance, entity)
+							if isinstance(response, ndb.Future):
+								response = yield response
+					except datastore_errors.BadValueError, e:
+						raise exceptions.RequiredInputError(e.message)
+					raise ndb.Return(response)
+
+				@ndb.tasklet
+				def matches_if_match_async(current):
+					if current is None:
+						raise ndb.Return(False)
+					if request.if_match.contains(current.etag()):
+						raise ndb.Return(True)
+					# Responses of this method are tagged from their transformed body, see below.
+					if transform_response:
+						data = yield current.transform_response_async(transform_fields, depth=transform_depth)
+						raise ndb.Return(request.if_match.contains(_data_etag(data)))
+					raise ndb.Return(False)
+
+				@ndb.tasklet
+				def write_async(entity):
+					if ndb.in_transaction() and entity.from_datastore:
+						# Re-read in the transaction, so a write committed since the lookup fails the precondition,
+						# and is not counted again, instead of being overwritten by the handler.
+						current = yield entity.key.get_async()
+						if request.if_match and not (yield matches_if_match_async(current)):
+							abort(412, message='Entity does not match If-Match.')
+						if current is None:
+							entity._from_datastore = False
+							entity._stored_counters = ()
+						else:
+							entity = current
+							entity._from_datastore = True
+							entity._stored_counters = entity._counter_names()
+
+					_write_log.keys = set()
+					try:
+						response = yield apply_request_async(entity)
+					finally:
+						written = _write_log.keys
+						_write_log.keys = None
+
+					# Only what the handler actually put or deleted is counted and indexed.
+					if counted:
+						if request.method == 'DELETE':
+							deltas = entity.key in written and cls._counter_deltas(entity._stored_counters, [])
+						else:
+							deltas = response.key in written and cls._counter_deltas(entity._stored_counters,
+							                                                         response._counter_names())
+						if deltas:
+							yield counters.update_in_transaction_async(deltas)
+					if cls._search_fields:
+						with profiler.span('search_index'):
+							search_index.update_later([key for key in written if key.kind() == cls._get_kind()])
+					raise ndb.Return((entity, response))
+
+				# Writes of counted models run in a transaction with their counter updates.
+				counted = cls._counters is not None and request.method != 'GET'
+				if request.if_match and not entity.from_datastore:
+					abort(412, message='Entity does not match If-Match.')
+				if request.if_match or counted:
+					entity, response = yield ndb.transaction_async(lambda: write_async(entity), xg=True)
+				else:
+					entity, response = yield write_async(entity)
 
-				try:
-					response = api_method(service_instance, entity)
-				except datastore_errors.BadValueError, e:
-					raise exceptions.RequiredInputError(e.message)
+				if request.method != 'GET' and cls._collection_cache:
+					cls.invalidate_collection_cache()
 
-				if transform_response:
-					response_data = response.transform_response(transform_fields)
-				else:
-					response_data = response.to_json()
-				return response_data
+				with profiler.span('serialization'):
+					if transform_response:
+						response_data = yield response.transform_response_async(transform_fields, depth=transform_depth)
+						etag = _data_etag(response_data)
+					else:
+						response_data = response.to_json()
+						etag = response.etag()
+				if request.method == 'DELETE':
+					raise ndb.Return(response_data)
+				raise ndb.Return((response_data, 200, {'ETag': '"%s"' % etag}))
+
+			@functools.wraps(api_method)
+			def entity_to_request_method(service_instance, **filter_data):
+				return entity_request_async(service_instance, filter_data).get_result()
 
 			return entity_to_request_method
 
 		return request_to_entity_decorator
 
 	@classmethod
-	def query_method(cls, transform_response=False, transform_fields=None, user_required=False):
+	def query_method(cls, transform_response=False, transform_fields=None, user_required=False,
+	                 transform_depth=DEFAULT_TRANSFORM_DEPTH, cache=False, cache_ttl=None):
 		"""Creates an API method decorator.
 		:param transform_request:
 		:param transform_fields:
 		:param user_required:
-		:return:
+		:param transform_depth:
+		:param cache: Boolean; whether collection pages are cached in memcache until the next write through
+					ModelBase.method.
+		:param cache_ttl: Integer; seconds a cached page is kept, config.COLLECTION_CACHE_TTL if not given.
+		:return: A decorator; as with method, the API method may be a tasklet.
 		"""
+		if cache:
+			cls._collection_cache = True
 
 		def request_to_query_decorator(api_method):
-			@functools.wraps(api_method)
-			def query_from_request_method(service_instance, **filter_data):
+			@ndb.tasklet
+			def query_request_async(service_instance, filter_data):
 				if user_required and not current_user.is_authenticated:
 					abort(401, message='Invalid user.')
 
 				if UNIQUE_ID in filter_data:
 					entity_key = ndb.Key(urlsafe=filter_data.get(UNIQUE_ID))
-					request_entity = (entity_key and entity_key.get()) or cls()
+					with profiler.span('filter_lookup'):
+						request_entity = (entity_key and (yield singleflight.get_async(
+							entity_key, **_read_options(entity_key.kind()))) or cls())
 					filter_data.pop(UNIQUE_ID)
-					return (transform_fields and request_entity.transform_response()) or request_entity.to_json()
+					if transform_fields:
+						# The transformed body holds referenced entities, so it is tagged as emitted.
+						with profiler.span('serialization'):
+							output = yield request_entity.transform_response_async()
+						raise ndb.Return(_etag_response(output, _data_etag(output)))
+					etag = request_entity.etag()
+					output = None
+					# The validator is known before serializing, so a matching If-None-Match skips it.
+					if not request.if_none_match.contains(etag):
+						with profiler.span('serialization'):
+							output = request_entity.to_json()
+					raise ndb.Return(_etag_response(output, etag))
+				elif SEARCH in request.args:
+					output = yield cls._search_collection_async(request.args, transform_response, transform_fields,
+					                                            transform_depth)
+					raise ndb.Return(_etag_response(output, _data_etag(output)))
 				else:
-					request_entity = cls()
-					request_entity.from_json(filter_data)
-					query_info = request_entity._endpoints_query_info
-					next_page = request.args.get(NEXT_PAGE)
-					if next_page:
-						query_info.cursor = datastore_query.Cursor(urlsafe=next_page)
-					query_info.SetQuery()
-					query = api_method(service_instance, query_info.query)
-					query_options = {'start_cursor': query_info.cursor}
-					items, next_cursor, more_results = query.fetch_page(DEFAULT_FETCH_LIMIT, **query_options)
+					with profiler.span('from_json'):
+						request_entity = cls()
+						request_entity.from_json(filter_data)
+						query_info = request_entity._endpoints_query_info
+						next_page = request.args.get(NEXT_PAGE)
+						if next_page:
+							query_info.cursor = datastore_query.Cursor(urlsafe=next_page)
+						cls._set_query_options(query_info, request.args)
+						try:
+							query_info.SetQuery()
+						except (ValueError, datastore_errors.BadValueError), e:
+							abort(400, message=str(e))
+						cls._check_query_shape(query_info.shape)
+					with profiler.span('handler'):
+						query = api_method(service_instance, query_info.query)
+						if isinstance(query, ndb.Future):
+							query = yield query
+
+					response_format = request.args.get(FORMAT)
+					if response_format == NDJSON:
+						raise ndb.Return(cls.export_ndjson(query, query_info, transform_response, transform_fields,
+						                                   transform_depth))
+					elif response_format:
+						abort(400, message='Unknown format %s.' % (response_format,))
+
+					limit = query_info.limit or DEFAULT_FETCH_LIMIT
+					total_counter = None
+					if request.args.get(TOTAL, '').lower() in TRUE_VALUES:
+						total_counter = cls._query_counter_name(query_info)
+						if total_counter is None:
+							abort(400, message='No total is kept for this query.')
+
+					cache_key = None
+					if cache:
+						cache_key = cls._collection_cache_key(query, limit, next_page, query_info.projection,
+						                                      query_info.keys_only, transform_response, transform_depth,
+						                                      total_counter)
+						cached = memcache.get(cache_key)
+						if cached is not None:
+							output, etag = cached
+							raise ndb.Return(_etag_response(output, etag))
+
+					with profiler.span('filter_lookup'):
+						total_future = total_counter and counters.total_async(total_counter)
+						items, next_cursor, more_results = yield query.fetch_page_async(limit, **query_info.fetch_options)
+						total = total_future and (yield total_future)
 
 					if not more_results:
 						next_cursor = None
 					else:
 						next_cursor = next_cursor.urlsafe()
 
-					if transform_response:
-						return cls.transform_response_collection(items, next_cursor=next_cursor)
-					else:
-						return cls.to_json_collection(items, next_cursor=next_cursor)
+					with profiler.span('serialization'):
+						if query_info.keys_only:
+							output = cls.keys_to_json_collection(items, next_cursor=next_cursor)
+						elif transform_response:
+							output = yield cls.transform_response_collection_async(items, next_cursor=next_cursor,
+							                                                       transform_fields=transform_fields,
+							                                                       depth=transform_depth)
+						else:
+							output = cls.to_json_collection(items, next_cursor=next_cursor)
+						if total_counter:
+							output['total'] = total
+						etag = _data_etag(output)
+					if cache_key:
+						memcache.set(cache_key, (output, etag), time=cache_ttl or config.COLLECTION_CACHE_TTL)
+					raise ndb.Return(_etag_response(output, etag))
+
+			@functools.wraps(api_method)
+			def query_from_request_method(service_instance, **filter_data):
+				return query_request_async(service_instance, filter_data).get_result()
 
 			return query_from_request_method
 
 		return request_to_query_decorator
 
-	def transform_response(self, transform_fields=None):
+	@classmethod
+	def export_ndjson(cls, query, query_info, transform_response=False, transform_fields=None,
+	                  transform_depth=DEFAULT_TRANSFORM_DEPTH):
+		"""
+		Streams every result of query as newline delimited JSON, one entity per line.
+
+		Results are fetched EXPORT_BATCH_SIZE at a time following cursors, the next batch being requested before the
+		current one is written, so only two batches are held in memory whatever the size of the result.
+		:param query: the final query.
+		:param query_info: the query info holding the start cursor, projection and keys_only options.
+		:return: A streamed flask Response.
+		"""
+		def batches():
+			fetch_options = query_info.fetch_options
+			future = query.fetch_page_async(EXPORT_BATCH_SIZE, **fetch_options)
+			while future is not None:
+				items, cursor, more_results = future.get_result()
+				future = None
+				if more_results and cursor:
+					fetch_options['start_cursor'] = cursor
+					future = query.fetch_page_async(EXPORT_BATCH_SIZE, **fetch_options)
+				yield items
+
+		def lines():
+			for items in batches():
+				if query_info.keys_only:
+					output = cls.keys_to_json_collection(items)
+				elif transform_response:
+					output = cls.transform_response_collection(items, transform_fields=transform_fields,
+					                                           depth=transform_depth)
+				else:
+					output = cls.to_json_collection(items)
+				for data in output['data']:
+					yield json.dumps(data) + '\n'
+
+		return Response(stream_with_context(lines()), mimetype=NDJSON_MIMETYPE)
+
+	@classmethod
+	def _collection_generation(cls):
+		"""Returns the current collection cache generation of the kind.
+
+		A missing counter is started from the current time in milliseconds rather than zero, so pages cached under
+		generations from before an eviction of the counter can't become reachable again.
+		"""
+		generation_key = COLLECTION_GENERATION_PREFIX + cls._get_kind()
+		generation = memcache.get(generation_key)
+		if generation is None:
+			memcache.add(generation_key, int(time.time() * 1000))
+			generation = memcache.get(generation_key)
+		return generation
+
+	@classmethod
+	def invalidate_collection_cache(cls):
+		"""Makes every cached collection page of the kind unreachable by bumping its generation."""
+		memcache.incr(COLLECTION_GENERATION_PREFIX + cls._get_kind(), initial_value=int(time.time() * 1000))
+
+	@classmethod
+	@ndb.tasklet
+	def _search_collection_async(cls, args, transform_response=False, transform_fields=None,
+	                             transform_depth=DEFAULT_TRANSFORM_DEPTH):
+		"""
+		Returns the collection page of the entities matching the full-text search query in args, most relevant first.
+
+		Only the limit, keys_only and next_page arguments apply to a search; filters, order and ancestor don't, and
+		the API method is not called.
+		:param args: the request arguments, with the query string under SEARCH.
+		:return: The collection output, next_page holding the search cursor of the next page.
+		"""
+		if not cls._search_fields:
+			abort(400, message='%s is not searchable.' % cls._get_kind())
+		try:
+			limit = min(int(args.get(LIMIT, DEFAULT_FETCH_LIMIT)), cls._max_fetch_limit)
+			with profiler.span('search'):
+				keys, next_cursor = search_index.search_keys(cls._get_kind(), args[SEARCH], limit, args.get(NEXT_PAGE))
+		except ValueError, e:
+			abort(400, message=str(e))
+
+		if args.get(KEYS_ONLY, '').lower() in TRUE_VALUES:
+			raise ndb.Return(cls.keys_to_json_collection(keys, next_cursor=next_cursor))
+		with profiler.span('filter_lookup'):
+			entities = yield _get_multi_async(keys)
+		# Documents of entities deleted outside of the API stay in the index until the next reindex.
+		items = [entity for entity in entities if entity is not None]
+		with profiler.span('serialization'):
+			if transform_response:
+				output = yield cls.transform_response_collection_async(items, next_cursor=next_cursor,
+				                                                       transform_fields=transform_fields,
+				                                                       depth=transform_depth)
+			else:
+				output = cls.to_json_collection(items, next_cursor=next_cursor)
+		raise ndb.Return(output)
+
+	@classmethod
+	def _collection_cache_key(cls, query, *options):
+		"""Returns the memcache key of a collection page, from the final query and the options of its response."""
+		digest = hashlib.sha1(repr((query, options))).hexdigest()
+		return '%s%s:%s:%s' % (COLLECTION_CACHE_PREFIX, cls._get_kind(), cls._collection_generation(), digest)
+
+	@classmethod
+	def batch_method(cls, transform_response=False, transform_fields=None, user_required=False,
+	                 transform_depth=DEFAULT_TRANSFORM_DEPTH, chunk_size=BATCH_CHUNK_SIZE):
+		"""Creates a bulk API method decorator.
+
+		The request body is a JSON array. For DELETE each item is an entity id (or an object holding one), otherwise
+		each item is an entity in JSON, updating the stored entity when it has an id and creating one when it has
+		not. Items are validated one by one through from_json, the api method receives the list of valid entities
+		and returns the ones to write (a subset of that list), which are then written in chunks of chunk_size with put_multi_async or
+		delete_multi_async, all chunks in flight together.
+		:param transform_response:
+		:param transform_fields:
+		:param user_required:
+		:param transform_depth:
+		:param chunk_size: Integer; number of entities per put_multi_async or delete_multi_async call.
+		:return: A decorator; the decorated method responds with one {status, data or message} result per item, in
+					request order.
+		"""
+
+		def request_to_batch_decorator(api_method):
+			@functools.wraps(api_method)
+			def batch_from_request_method(service_instance, **filter_data):
+				if user_required and not current_user.is_authenticated:
+					raise exceptions.AuthenticationError
+
+				items = request.get_json()
+				if not isinstance(items, list):
+					raise exceptions.RequiredInputError('A JSON array of items is required.')
+				if len(items) > MAX_BATCH_ITEMS:
+					raise exceptions.RequiredInputError('At most %d items are allowed.' % MAX_BATCH_ITEMS)
+
+				deleting = request.method == 'DELETE'
+				results = [None] * len(items)
+				entities = cls._entities_from_batch(items, deleting, results)
+				positions = dict((id(entity), index) for index, entity in enumerate(entities) if entity)
+
+				try:
+					accepted = api_method(service_instance, [entity for entity in entities if entity])
+				except datastore_errors.BadValueError, e:
+					raise exceptions.RequiredInputError(e.message)
+
+				writes = []
+				for entity in accepted:
+					index = positions.pop(id(entity), None)
+					if index is None:
+						if any(entity is written_entity for _, written_entity in writes):
+							continue
+						raise ValueError('%s returned an entity which is not one of the batch items.' %
+						                 (api_method.__name__,))
+					writes.append((index, entity))
+				for index in positions.itervalues():
+					results[index] = _batch_error(400, 'Item rejected.')
+
+				written = cls._write_batch(writes, deleting, chunk_size, results)
+				if writes and cls._collection_cache:
+					cls.invalidate_collection_cache()
+				removed, added = [], []
+				for _, entity in written:
+					removed.extend(entity._stored_counters)
+					if not deleting:
+						added.extend(entity._counter_names())
+				cls._update_counters_async(removed, added).get_result()
+				if cls._search_fields:
+					search_index.update_later([entity.key for _, entity in written])
+
+				if deleting:
+					output = cls.keys_to_json_collection([entity.key for _, entity in written])
+				elif transform_response:
+					output = cls.transform_response_collection([entity for _, entity in written],
+					                                           transform_fields=transform_fields, depth=transform_depth)
+				else:
+					output = cls.to_json_collection([entity for _, entity in written])
+				for (index, _), data in zip(written, output['data']):
+					results[index] = {'status': 200, 'data': data}
+				return {'data': results}
+
+			return batch_from_request_method
+
+		return request_to_batch_decorator
+
+	@classmethod
+	def _entities_from_batch(cls, items, deleting, results):
+		"""Returns the entity of each batch item, None for the items whose error is set in results.
+
+		Items sharing an id are all rejected, since each item is written as its own entity.
+		"""
+		entities = [None] * len(items)
+		keys = {}
+		for index, item in enumerate(items):
+			try:
+				if isinstance(item, dict):
+					url_string = item.get(UNIQUE_ID)
+				elif deleting:
+					url_string = item
+				else:
+					raise ValueError('Item must be a JSON object.')
+
+				if url_string:
+					key = ndb.Key(urlsafe=url_string)
+					if key.kind() != cls._get_kind():
+						raise ValueError('Item id is not a %s key.' % cls._get_kind())
+					keys[index] = key
+				elif deleting:
+					raise ValueError('Item id is required.')
+				else:
+					entities[index] = cls()
+			except BATCH_ITEM_ERRORS, e:
+				results[index] = _batch_error(400, str(e))
+
+		key_counts = collections.Counter(keys.itervalues())
+		for index, key in keys.items():
+			if key_counts[key] > 1:
+				results[index] = _batch_error(400, 'Item id is repeated in the batch.')
+				del keys[index]
+
+		futures = ndb.get_multi_async(keys.values(), **cls._read_options())
+		for index, future in zip(keys.keys(), futures):
+			entity = future.get_result()
+			if entity is None:
+				results[index] = _batch_error(404, 'Item does not exist.')
+			else:
+				entity._from_datastore = True
+				entity._stored_counters = entity._counter_names()
+				entities[index] = entity
+
+		if not deleting:
+			for index, entity in enumerate(entities):
+				if entity is None:
+					continue
+				try:
+					entity.from_json(items[index])
+					entity._check_initialized()
+				except BATCH_ITEM_ERRORS, e:
+					results[index] = _batch_error(400, str(e))
+					entities[index] = None
+		return entities
+
+	@staticmethod
+	def _write_batch(writes, deleting, chunk_size, results):
+		"""Writes (index, entity) pairs in chunks, returns the pairs written and sets errors in results."""
+		futures = []
+		for start in xrange(0, len(writes), chunk_size):
+			chunk = [entity for _, entity in writes[start:start + chunk_size]]
+			if deleting:
+				futures.extend(ndb.delete_multi_async([entity.key for entity in chunk]))
+			else:
+				futures.extend(ndb.put_multi_async(chunk))
+
+		written = []
+		for (index, entity), future in zip(writes, futures):
+			try:
+				future.get_result()
+			except BATCH_ITEM_ERRORS, e:
+				results[index] = _batch_error(500, str(e))
+			else:
+				written.append((index, entity))
+		return written
+
+	@classmethod
+	def _set_query_options(cls, query_info, args):
+		"""Sets filters, order, ancestor, limit, projection and keys_only on query_info from request arguments.
+
+		Arguments other than RESERVED_ARGS are property filters, either <name>=<value> for equality or
+		<name>__<operator>=<value> with an operator from FILTER_OPERATORS. Aborts on invalid values.
+		"""
+		try:
+			if LIMIT in args:
+				query_info.limit = min(int(args[LIMIT]), cls._max_fetch_limit)
+			if FIELDS in args:
+				query_info.projection = args[FIELDS]
+			if KEYS_ONLY in args:
+				query_info.keys_only = args[KEYS_ONLY].lower() in TRUE_VALUES
+			if ORDER in args:
+				query_info.order = args[ORDER]
+			if ANCESTOR in args:
+				query_info.ancestor = ndb.Key(urlsafe=args[ANCESTOR])
+			for arg_name, value in args.iteritems():
+				if arg_name in RESERVED_ARGS:
+					continue
+				attr_name, _, operator = arg_name.partition(FILTER_OPERATOR_SEPARATOR)
+				opsymbol = FILTER_OPERATORS.get(operator or 'eq')
+				if opsymbol is None:
+					raise ValueError('Unknown filter operator %s.' % (operator,))
+				query_info.AddPropertyFilter(attr_name, opsymbol, value)
+		except (AttributeError, TypeError, ValueError, datastore_errors.BadValueError), e:
+			abort(400, message=str(e))
+
+	@classmethod
+	def _check_query_shape(cls, shape):
+		"""Logs queries needing a composite index which is not generated from _query_shapes."""
+		if shape.index_properties() and shape not in cls._query_shapes:
+			logging.warning('%s query %r is not declared in _query_shapes, index.yaml may lack its index.',
+			                cls._get_kind(), shape)
+
+	def _counter_names(self):
+		"""Returns the names of the counters the entity is counted in, none when the model is not counted."""
+		if self._counters is None:
+			return []
+		kind = self._get_kind()
+		return [counters.counter_name(kind)] + [counters.counter_name(kind, name, getattr(self, name))
+		                                        for name in self._counters]
+
+	@staticmethod
+	def _counter_deltas(removed, added):
+		"""Returns the counter deltas decrementing the counters named in removed and incrementing those in added."""
+		deltas = collections.Counter(added)
+		deltas.subtract(removed)
+		return deltas
+
+	@classmethod
+	def _update_counters_async(cls, removed, added):
+		"""Decrements the counters named in removed and increments those in added."""
+		return counters.update_async(cls._counter_deltas(removed, added))
+
+	@classmethod
+	def _query_counter_name(cls, query_info):
+		"""Returns the name of the counter holding the number of results of a query, or None if none is kept.
+
+		Counters are kept for the whole kind and for each property of _counters, so only queries without filters or
+		with a single equality filter on one of those properties have one.
+		"""
+		values = query_info.equality_values
+		if cls._counters is None or values is None or len(values) > 1:
+			return None
+		if not values:
+			return counters.counter_name(cls._get_kind())
+		name, value = values.items()[0]
+		if name not in cls._counters:
+			return None
+		return counters.counter_name(cls._get_kind(), name, value)
+
+	@staticmethod
+	def _referenced_keys(entity):
+		"""Returns every ndb.Key held by the KeyProperty values of an entity."""
+		keys = []
+		for prop in entity._properties.itervalues():
+			if not isinstance(prop, ndb.KeyProperty):
+				continue
+			try:
+				value = prop._get_value(entity)
+			except ndb.UnprojectedPropertyError:
+				continue
+			if prop._repeated:
+				keys.extend(key for key in value if key is not None)
+			elif value is not None:
+				keys.append(value)
+		return keys
+
+	@classmethod
+	def resolve_references(cls, entities, depth=DEFAULT_TRANSFORM_DEPTH):
+		"""
+		Fetches the entities referenced by KeyProperty values, one batched lookup per level.
+
+		All keys referenced by the entities of a level are deduplicated and fetched together with
+		ndb.get_multi_async; the entities fetched become the next level until depth is reached.
+		:param entities: iterable of entities whose references are to be resolved.
+		:param depth: number of levels of references to resolve.
+		:return: Dictionary mapping each referenced ndb.Key to its entity (None if it does not exist).
+		"""
+		return cls.resolve_references_async(entities, depth).get_result()
+
+	@classmethod
+	@ndb.tasklet
+	def resolve_references_async(cls, entities, depth=DEFAULT_TRANSFORM_DEPTH):
+		"""Tasklet version of resolve_references."""
+		references = {}
+		level = entities
+		for _ in xrange(depth):
+			keys = set()
+			for entity in level:
+				keys.update(key for key in cls._referenced_keys(entity) if key not in references)
+			if not keys:
+				break
+
+			keys = list(keys)
+			fetched = yield _get_multi_async(keys)
+			level = []
+			for key, reference in zip(keys, fetched):
+				references[key] = reference
+				if reference is not None:
+					level.append(reference)
+		raise ndb.Return(references)
+
+	def transform_response(self, transform_fields=None, references=None, depth=DEFAULT_TRANSFORM_DEPTH):
 		"""
 		Select ndb.Key property types for their respective data response.
 		:param transform_fields: optional list or tuple which is used to specify returned properties for a
 					ndb.Key property.
+		:param references: optional dictionary mapping ndb.Key to entity, as returned by resolve_references;
+					when not given the references of this entity are fetched.
+		:param depth: number of levels of ndb.Key properties to transform.
 		:return:
 		"""
-		data = self._to_dict()
-		for property_name, value in data.iteritems():
-			if isinstance(value, ndb.Key):
-				property_value = value.get()
-				if property_value:
-					property_value = property_value.to_json()
-			else:
-				property_value = self.to_json_data(value)
-			data[property_name] = property_value
+		if references is None:
+			references = self.resolve_references([self], depth)
+
+		def encode_reference(key):
+			reference = references.get(key)
+			if not reference:
+				return None
+			if depth > 1 and isinstance(reference, ModelBase):
+				return reference.transform_response(transform_fields, references, depth - 1)
+			return reference.to_json()
+
+		data = self._get_json_codec().encode(self, key_encoder=encode_reference)
 		data['id'] = self.key.urlsafe()
 		return data
 
+	@ndb.tasklet
+	def transform_response_async(self, transform_fields=None, depth=DEFAULT_TRANSFORM_DEPTH):
+		"""Tasklet version of transform_response, fetching the references with resolve_references_async."""
+		references = yield self.resolve_references_async([self], depth)
+		raise ndb.Return(self.transform_response(transform_fields, references, depth))
+
 	@classmethod
-	def transform_response_collection(cls, items, next_cursor=None, transform_fields=None):
+	def transform_response_collection(cls, items, next_cursor=None, transform_fields=None,
+	                                  depth=DEFAULT_TRANSFORM_DEPTH):
 		"""
 		Transforming a collection of response data
 		:param transform_fields:
+		:param depth: number of levels of ndb.Key properties to transform.
 		:return:
 		"""
+		return cls.transform_response_collection_async(items, next_cursor, transform_fields, depth).get_result()
+
+	@classmethod
+	@ndb.tasklet
+	def transform_response_collection_async(cls, items, next_cursor=None, transform_fields=None,
+	                                        depth=DEFAULT_TRANSFORM_DEPTH):
+		"""Tasklet version of transform_response_collection."""
+		references = yield cls.resolve_references_async(items, depth)
 		output = {NEXT_PAGE: next_cursor, 'data': []}
 		for item in items:
-			output['data'].append(item.transform_response())
-		return output
+			output['data'].append(item.transform_response(transform_fields, references, depth))
+		raise ndb.Return(output)
@@ -0,0 +1,6 @@
+from google.appengine.ext import ndb
+
+
+class RevokedTokens(ndb.Model):
+	"""A bearer token revoked before its expiry, keyed by the token id."""
+	expires = ndb.DateTimeProperty(required=True)
@@ -1,5 +1,5 @@
 from google.appengine.ext import ndb
-from model_base import ModelBase
+from model_base import ModelBase, QueryShape
 from users import Users
 
 
@@ -7,3 +7,14 @@ class Tasks(ModelBase):
 	owner = ndb.KeyProperty(kind=Users, required=True)
 	title = ndb.StringProperty(required=True)
 	date_completed = ndb.DateTimeProperty(auto_now_add=True)
+
+	_query_shapes = (
+		QueryShape(filters=('owner',), order='-date_completed'),
+		QueryShape(filters=('owner',), inequality='date_completed', order='date_completed'),
+		QueryShape(filters=('owner',), projection=('title',)),
+	)
+	_counters = ('owner',)
+	_search_fields = ('title',)
+	# Tasks churn, and are mostly read through queries which never use memcache, so the memcache writes and
+	# invalidations of every put would rarely pay off.
+	_use_memcache = False
@@ -1,6 +1,17 @@
 from model_base import ModelBase
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import ndb
-from webapp2_extras import security
+from server import config
+from server.commons import singleflight
+from server.commons.cache import LRUCache
+
+USER_CACHE_PREFIX = 'users:username:'
+# Placeholder a reader adds to memcache before loading a user, see get_cached.
+_LEASE = 'lease'
+
+user_cache = LRUCache(config.USER_CACHE_SIZE, config.USER_CACHE_LOCAL_TTL)
 
 
 class Users(ModelBase):
@@ -10,6 +21,11 @@ class Users(ModelBase):
     date_registered = ndb.DateTimeProperty(auto_now_add=True)
     date_last_updated = ndb.DateTimeProperty(auto_now=True)
 
+    # Read on every authenticated request and rarely written: kept in memcache for a day.
+    _use_cache = True
+    _use_memcache = True
+    _memcache_timeout = 24 * 60 * 60
+
     @property
     def is_active(self):
         return True
@@ -23,11 +39,98 @@ class Users(ModelBase):
 
     @classmethod
     def get_by_username(cls, username):
-        users = cls.query(cls.username == username).fetch()
+        user = singleflight.get_async(ndb.Key(cls, username), **cls._read_options()).get_result()
+        if user and user.username == username:
+            return user
+        if not config.USERS_LEGACY_LOOKUP:
+            return None
+        users = cls.query(cls.username == username).fetch(1, **cls._read_options())
         return users[0] if users else None
 
+    @classmethod
+    def create(cls, username, password):
+        """Creates a user keyed by username, returns None if the username is already registered."""
+        return cls.insert(cls(username=username, password=password))
+
+    @classmethod
+    def insert(cls, user):
+        """Stores a new user keyed by its username, returns None if the username is already registered."""
+        user._check_initialized()
+        if config.USERS_LEGACY_LOOKUP and cls.query(cls.username == user.username).get(keys_only=True):
+            return None
+        return cls._insert_by_id(user)
+
+    @classmethod
+    @ndb.transactional
+    def _insert_by_id(cls, user):
+        if cls.get_by_id(user.username):
+            return None
+        user.key = ndb.Key(cls, user.username)
+        user.put()
+        return user
+
+    def _pre_put_hook(self):
+        if self.key is None or self.key.id() is None:
+            if self.username:
+                self.key = ndb.Key(Users, self.username)
+        elif isinstance(self.key.id(), basestring) and self.key.id() != self.username:
+            raise datastore_errors.BadValueError('The username of a user can\'t be changed.')
+
+    @classmethod
+    def get_cached(cls, username):
+        """Returns a user by username, looking in the process cache, memcache and the datastore in turn.
+
+        The process cache is only cleared on the instance writing the user, see config.USER_CACHE_LOCAL_TTL.
+        """
+        cache_key = USER_CACHE_PREFIX + username
+        data = user_cache.get(cache_key)
+        if data is None:
+            client = memcache.Client()
+            data = client.get(cache_key)
+            if data is None:
+                # The user is only cached by compare-and-set on a lease taken before reading it: invalidate_cached
+                # deletes the lease, so a user read before a write can't be cached after its invalidation.
+                client.add(cache_key, _LEASE, time=config.USER_CACHE_LEASE_TTL)
+                leased = client.gets(cache_key) == _LEASE
+                user = cls.get_by_username(username)
+                if user and leased:
+                    data = user._to_pb().Encode()
+                    if client.cas(cache_key, data, time=config.USER_CACHE_MEMCACHE_TTL):
+                        user_cache.set(cache_key, data)
+                return user
+            if data == _LEASE:
+                return cls.get_by_username(username)
+            user_cache.set(cache_key, data)
+        return cls._from_pb(entity_pb.EntityProto(data))
+
+    @classmethod
+    def invalidate_cached(cls, username):
+        cache_key = USER_CACHE_PREFIX + username
+        user_cache.delete(cache_key)
+        memcache.delete(cache_key)
+
+    @classmethod
+    @ndb.transactional
+    def set_authenticated(cls, key, is_authenticated):
+        """Sets is_authenticated on the stored user of key rather than on a possibly stale copy, returns the user."""
+        user = key.get()
+        if user is not None and user.is_authenticated != is_authenticated:
+            user.is_authenticated = is_authenticated
+            user.put()
+        return user
+
+    def _post_put_hook(self, future):
+        super(Users, self)._post_put_hook(future)
+        self.invalidate_cached(self.username)
+        if ndb.in_transaction():
+            # A reader may cache the user again before the transaction commits.
+            username = self.username
+            ndb.get_context().call_on_commit(lambda: self.invalidate_cached(username))
+
     def hash_password(self):
+        from webapp2_extras import security
         self.password = security.generate_password_hash(self.password, length=32)
 
     def verify_password(self, password):
+        from webapp2_extras import security
         return security.check_password_hash(password, self.password)
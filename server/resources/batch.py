@@ -0,0 +1,105 @@
+import json
+import logging
+import threading
+from flask import current_app, request
+from flask_restful import Resource
+from werkzeug.test import EnvironBuilder
+from server.commons import exceptions
+from server.models.model_base import MAX_BATCH_ITEMS
+
+BATCH_PATH = '/batch'
+MAX_BATCH_REQUESTS = 20
+# Headers of the batch request passed on to every sub-request, so they run as the same user.
+FORWARDED_HEADERS = ('Cookie', 'Authorization')
+# Headers a sub-request may set itself; the forwarded headers can't be overridden.
+SUB_REQUEST_HEADERS = ('Accept', 'If-Match', 'If-None-Match')
+# Paths of the API resources sub-requests may be sent to. Dispatching in process skips the app.yaml handlers, so
+# paths they restrict, such as /_admin, must not be reachable.
+BATCH_RESOURCES = ('/users', '/tasks', '/tokens')
+
+
+def _sub_request_error(status, message):
+	return {'status': status, 'body': {'message': message}}
+
+
+def _fan_out(sub_request):
+	"""Returns the number of items a sub-request writes, the length of its body for the :batch methods, else 1."""
+	body = isinstance(sub_request, dict) and sub_request.get('body')
+	return len(body) if isinstance(body, list) else 1
+
+
+def _is_batch_resource(path):
+	"""Returns whether path is one of BATCH_RESOURCES, an entity of one, or a custom method of one."""
+	return any(path == resource or path.startswith((resource + '/', resource + ':')) for resource in BATCH_RESOURCES)
+
+
+def dispatch(app, sub_request, headers):
+	"""Runs one sub-request through the application and returns its status and JSON body.
+
+	:param app: the Flask application.
+	:param sub_request: Dictionary with a path, and optionally a method (GET by default), a JSON body and headers.
+	:param headers: Dictionary of headers forwarded from the batch request.
+	:return: Dictionary holding the status code and the decoded body of the response.
+	"""
+	if not isinstance(sub_request, dict) or not str(sub_request.get('path', '')).startswith('/'):
+		return _sub_request_error(400, 'Each request needs a path starting with /.')
+	path = sub_request['path']
+	if path.split('?')[0] == BATCH_PATH:
+		return _sub_request_error(400, 'Batch requests can\'t be nested.')
+	if not _is_batch_resource(path.split('?')[0]):
+		return _sub_request_error(400, 'Only %s can be requested in a batch.' % ', '.join(BATCH_RESOURCES))
+	sub_request_headers = sub_request.get('headers') or {}
+	if not isinstance(sub_request_headers, dict):
+		return _sub_request_error(400, 'Request headers must be a JSON object.')
+
+	request_headers = dict((name, str(value)) for name, value in sub_request_headers.iteritems()
+	                       if name.title() in SUB_REQUEST_HEADERS)
+	request_headers.update(headers)
+	body = sub_request.get('body')
+	builder = EnvironBuilder(path=path, method=sub_request.get('method', 'GET').upper(), headers=request_headers,
+	                         data=json.dumps(body) if body is not None else None, content_type='application/json')
+	try:
+		with app.request_context(builder.get_environ()):
+			response = app.full_dispatch_request()
+	except Exception:
+		logging.exception('Batch sub-request to %s failed.', path)
+		return _sub_request_error(500, 'something went wrong')
+	finally:
+		builder.close()
+
+	data = response.get_data()
+	if response.mimetype == 'application/json' and data:
+		data = json.loads(data)
+	return {'status': response.status_code, 'body': data}
+
+
+class BatchResource(Resource):
+	def post(self):
+		"""Runs a JSON array of sub-requests concurrently, one thread each, and returns their results in order.
+
+		Sub-requests go through the same resources as standalone requests, so their datastore RPCs overlap instead of
+		paying one HTTP round trip each. Each one needs its own Flask request context, which is bound to its thread,
+		so they can't share an event loop; the items of all sub-requests are capped together at MAX_BATCH_ITEMS, so a
+		batch of :batch sub-requests writes no more than one of them may.
+		"""
+		sub_requests = request.get_json()
+		if not isinstance(sub_requests, list):
+			raise exceptions.RequiredInputError('A JSON array of requests is required.')
+		if len(sub_requests) > MAX_BATCH_REQUESTS:
+			raise exceptions.RequiredInputError('At most %d requests are allowed.' % MAX_BATCH_REQUESTS)
+		if sum(_fan_out(sub_request) for sub_request in sub_requests) > MAX_BATCH_ITEMS:
+			raise exceptions.RequiredInputError('At most %d items are allowed across requests.' % MAX_BATCH_ITEMS)
+
+		app = current_app._get_current_object()
+		headers = dict((name, request.headers[name]) for name in FORWARDED_HEADERS if name in request.headers)
+		results = [None] * len(sub_requests)
+
+		def run(index):
+			results[index] = dispatch(app, sub_requests[index], headers)
+
+		threads = [threading.Thread(target=run, args=(index,)) for index in xrange(len(sub_requests))]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		return {'data': results}
@@ -8,6 +8,16 @@ class TasksResource(Resource):
 		task.put()
 		return task
 
-	@Tasks.query_method(transform_response=True)
+	@Tasks.query_method(transform_response=True, cache=True)
 	def get(self, tasks):
 		return tasks
+
+
+class TasksBatchResource(Resource):
+	@Tasks.batch_method(transform_response=True, user_required=True)
+	def post(self, tasks):
+		return tasks
+
+	@Tasks.batch_method(user_required=True)
+	def delete(self, tasks):
+		return tasks
@@ -0,0 +1,26 @@
+from flask import request
+from flask_restful import Resource
+from server.commons import exceptions
+from server.commons import tokens
+from server.config import TOKEN_TTL
+from server.models.users import Users
+
+
+class TokensResource(Resource):
+	def post(self):
+		"""Exchanges a username and password for a bearer token, reading the user once and writing nothing."""
+		data = request.get_json(silent=True) or {}
+		username, password = data.get('username'), data.get('password')
+		if not username or not password:
+			raise exceptions.RequiredInputError('A username and password are required.')
+		user = Users.get_by_username(username)
+		if not user or not user.verify_password(password):
+			raise exceptions.AuthenticationError
+		return {'token': tokens.issue(user), 'token_type': 'Bearer', 'expires_in': TOKEN_TTL}
+
+	def delete(self):
+		"""Revokes the bearer token of the request."""
+		token = tokens.bearer_token(request)
+		if not token or not tokens.revoke(token):
+			raise exceptions.AuthenticationError
+		return {'message': 'Token revoked'}
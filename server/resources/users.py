@@ -1,13 +1,16 @@
 from flask_restful import Resource
 from flask_restful import abort
+from server.commons import exceptions
 from server.models.users import Users
 
 
 class UsersResource(Resource):
 	@Users.method()
 	def post(self, user):
-		user.put()
-		return user
+		created = Users.insert(user)
+		if created is None:
+			raise exceptions.ConflictError('Username is already registered')
+		return created
 
 	@Users.method()
 	def put(self, user):
@@ -21,6 +24,7 @@ class UsersResource(Resource):
 		if not user.from_datastore:
 			abort(400, message='User does not exist')
 		user.key.delete()
+		Users.invalidate_cached(user.username)
 		return user
 
 	@Users.query_method()
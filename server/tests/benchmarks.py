@@ -0,0 +1,473 @@
+"""Benchmarks of the API hot paths against the local testbed stubs.
+
+Run from the project root with the App Engine SDK on the path:
+
+    python -m server.tests.benchmarks api --users 10 --tasks 20 --output results.json
+    python -m server.tests.benchmarks api --compare baseline.json --threshold 0.2
+    python -m server.tests.benchmarks codec --entities 5000
+    python -m server.tests.benchmarks query_templates --requests 10000
+    python -m server.tests.benchmarks entity_overhead --entities 5000
+    python -m server.tests.benchmarks batch --tasks 1000 --batch-size 500
+    python -m server.tests.benchmarks startup [module ...]
+
+api reports the throughput, latency percentiles and average number of RPCs per
+call by service method of every scenario, as JSON. With --compare, the run
+fails if a scenario's p50 latency or RPCs per call grew by more than the
+threshold against the baseline results.
+
+codec, query_templates and entity_overhead are micro-benchmarks of the entity
+JSON codec, the query building of GET /tasks and the cost ModelBase adds to
+entities loaded from the datastore; the "before" figures replay the code those
+paths used before they were optimized. batch compares task creation through
+POST /tasks and POST /tasks:batch.
+
+Every benchmark but startup runs in the testbed fixture of stubs(). startup
+times the imports of a new instance, so the application and SDK modules are
+only imported inside the benchmarks, never at the top of this module.
+"""
+import __builtin__
+import argparse
+import collections
+import contextlib
+import datetime
+import gc
+import json
+import sys
+import time
+import timeit
+
+PASSWORD = 'benchmark'
+PERCENTILES = (50, 95, 99)
+DEFERRED_MODULES = ('server.forms', 'webapp2_extras.security')
+
+_builtin_import = __builtin__.__import__
+
+
+@contextlib.contextmanager
+def stubs():
+    """Activates a testbed with the stubs of every service the app uses, and empties the process caches."""
+    from google.appengine.ext import testbed
+    from server.commons import singleflight
+    from server.models.users import user_cache
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_search_stub()
+    bed.init_taskqueue_stub()
+    user_cache.clear()
+    singleflight.clear()
+    try:
+        yield bed
+    finally:
+        bed.deactivate()
+
+
+def logged_in_app(username):
+    """Returns a webtest app logged in as a newly registered user, and the urlsafe key of the user."""
+    import webtest
+    from server.main import app
+    from server.models.users import Users
+    testapp = webtest.TestApp(app)
+    testapp.post('/register', params={'username': username, 'password': PASSWORD, 'confirm_password': PASSWORD},
+                 status=302)
+    testapp.post('/login', params={'username': username, 'password': PASSWORD}, status=302)
+    return testapp, Users.get_by_username(username).key.urlsafe()
+
+
+class RpcCounter(object):
+    """Counts the RPCs of the testbed API proxy made while active."""
+
+    def __init__(self):
+        from google.appengine.api import apiproxy_stub_map
+        self.counts = None
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('benchmark_rpcs', self._hook)
+
+    def _hook(self, service, call, request, response):
+        if self.counts is not None:
+            self.counts['%s.%s' % (service, call)] += 1
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    last = len(samples) - 1
+    return dict(('p%d' % percentile, samples[int(round(last * percentile / 100.0))] * 1000)
+                for percentile in PERCENTILES)
+
+
+class ApiBenchmark(object):
+    def __init__(self, users, tasks, iterations):
+        import webtest
+        from server.main import app
+        self.users = users
+        self.tasks = tasks
+        self.iterations = iterations
+        self.rpcs = RpcCounter()
+        self.testapp = webtest.TestApp(app)
+        self.results = collections.OrderedDict()
+
+    def seed(self):
+        from google.appengine.ext import ndb
+        from webapp2_extras import security
+        from server.models.users import Users
+        from server.models.tasks import Tasks
+        password = security.generate_password_hash(PASSWORD, length=32)
+        owners = ndb.put_multi([Users(username='user%d' % i, password=password) for i in xrange(self.users)])
+        ndb.put_multi([Tasks(owner=owner, title='task%d' % i) for owner in owners for i in xrange(self.tasks)])
+        self.user_keys = owners
+        self.task_keys = Tasks.query().fetch(keys_only=True)
+
+    def login(self):
+        self.testapp.reset()
+        self.testapp.post('/login', params={'username': 'user0', 'password': PASSWORD}, status=302)
+
+    def measure(self, name, func, setup=None):
+        """Runs func iterations times, setup untimed before each call, and records its results under name."""
+        latencies = []
+        counts = collections.Counter()
+        for iteration in xrange(self.iterations):
+            argument = setup(iteration) if setup else None
+            self.rpcs.counts = counts
+            start = time.time()
+            func(argument)
+            latencies.append(time.time() - start)
+            self.rpcs.counts = None
+        self.results[name] = {
+            'throughput': self.iterations / sum(latencies),
+            'latency_ms': percentiles(latencies),
+            'rpcs_per_call': dict((rpc, count / float(self.iterations)) for rpc, count in counts.iteritems()),
+        }
+
+    def run(self):
+        from server.models.users import Users
+        from server.models.tasks import Tasks
+        self.seed()
+        owner = self.user_keys[0].urlsafe()
+        task_path = '/tasks/%s' % self.task_keys[0].urlsafe()
+        page = Tasks.query().fetch(10)
+
+        self.measure('login', lambda _: self.login())
+        self.login()
+        self.measure('POST /tasks', lambda _: self.testapp.post(
+            '/tasks', params=json.dumps({'owner': owner, 'title': 'new'}), content_type='application/json'))
+        self.measure('GET /tasks', lambda _: self.testapp.get('/tasks'),
+                     setup=lambda _: Tasks.invalidate_collection_cache())
+        self.measure('GET /tasks cached', lambda _: self.testapp.get('/tasks'))
+        self.measure('GET /tasks/<id>', lambda _: self.testapp.get(task_path))
+        self.measure('PUT /users/<id>', lambda _: self.testapp.put(
+            '/users/%s' % owner, params=json.dumps({'password': 'changed'}), content_type='application/json'))
+        self.measure('DELETE /users/<id>', lambda path: self.testapp.delete(path),
+                     setup=lambda i: '/users/%s' % Users(username='deleted%d' % i, password='x').put().urlsafe())
+        self.measure('to_json x10', lambda _: [task.to_json() for task in page])
+        self.measure('transform_response_collection x10', lambda _: Tasks.transform_response_collection(page))
+        return self.results
+
+
+def compare(results, baseline, threshold):
+    """Returns descriptions of the scenarios slower or making more RPCs than baseline by more than threshold."""
+    regressions = []
+    for name, result in results.iteritems():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['latency_ms']['p50'] > base['latency_ms']['p50'] * (1 + threshold):
+            regressions.append('%s: p50 %.2fms -> %.2fms' % (name, base['latency_ms']['p50'],
+                                                           result['latency_ms']['p50']))
+        rpcs, base_rpcs = sum(result['rpcs_per_call'].values()), sum(base['rpcs_per_call'].values())
+        if rpcs > base_rpcs * (1 + threshold) + 0.01:
+            regressions.append('%s: RPCs per call %.2f -> %.2f' % (name, base_rpcs, rpcs))
+    return regressions
+
+
+def run_api(args):
+    with stubs():
+        results = ApiBenchmark(args.users, args.tasks, args.iterations).run()
+
+    output = json.dumps({
+        'config': {'users': args.users, 'tasks': args.tasks, 'iterations': args.iterations},
+        'scenarios': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print output
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['scenarios']
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            sys.stderr.write('REGRESSION %s\n' % regression)
+        return 1 if regressions else 0
+    return 0
+
+
+def legacy_codec():
+    """Returns the to_json and from_json functions ModelBase used before serialization was compiled per model class,
+    with per-value isinstance chains."""
+    from google.appengine.ext import ndb
+    from server import utils
+
+    def to_json_data(value):
+        if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+            return utils.date_to_str(value)
+        elif isinstance(value, ndb.Key):
+            return value.urlsafe()
+        return value
+
+    def to_json(entity):
+        data = entity._to_dict()
+        for name, value in data.iteritems():
+            data[name] = to_json_data(value)
+        data.update({'id': entity.key.urlsafe()})
+        return data
+
+    def from_json(entity, request_data):
+        for name, value in request_data.iteritems():
+            prop_type = entity._properties.get(name)
+            if prop_type:
+                if isinstance(prop_type, (ndb.DateProperty, ndb.DateTimeProperty, ndb.TimeProperty)):
+                    value = utils.date_from_str(prop_type, value)
+                elif isinstance(prop_type, ndb.KeyProperty):
+                    value = ndb.Key(urlsafe=value)
+                setattr(entity, name, value)
+
+    return to_json, from_json
+
+
+def entities_per_sec(func, entities, rounds):
+    seconds = min(timeit.repeat(lambda: [func(entity) for entity in entities], number=1, repeat=rounds))
+    return len(entities) / seconds
+
+
+def run_codec(args):
+    from server.models.users import Users
+    from server.models.tasks import Tasks
+    legacy_to_json, legacy_from_json = legacy_codec()
+    now = datetime.datetime(2016, 1, 1, 12, 30)
+
+    with stubs():
+        users = [Users(id=i + 1, username='user%d' % i, password='password', date_registered=now,
+                       date_last_updated=now) for i in xrange(args.entities)]
+        tasks = [Tasks(id=i + 1, owner=user.key, title='task%d' % i, date_completed=now)
+                 for i, user in enumerate(users)]
+        results = {}
+        for name, entities in (('Users', users), ('Tasks', tasks)):
+            payloads = [legacy_to_json(entity) for entity in entities]
+            for payload in payloads:
+                payload.pop('id')
+            pairs = zip([type(entity)() for entity in entities], payloads)
+            results[name] = {
+                'to_json_before': entities_per_sec(legacy_to_json, entities, args.rounds),
+                'to_json_after': entities_per_sec(lambda entity: entity.to_json(), entities, args.rounds),
+                'from_json_before': entities_per_sec(lambda pair: legacy_from_json(*pair), pairs, args.rounds),
+                'from_json_after': entities_per_sec(lambda pair: pair[0].from_json(pair[1]), pairs, args.rounds),
+            }
+
+    print '%-6s %-10s %14s %14s %8s' % ('model', 'operation', 'before (e/s)', 'after (e/s)', 'speedup')
+    for name, result in sorted(results.iteritems()):
+        for operation in ('to_json', 'from_json'):
+            before = result[operation + '_before']
+            after = result[operation + '_after']
+            print '%-6s %-10s %14.0f %14.0f %7.2fx' % (name, operation, before, after, after / before)
+    return 0
+
+
+def legacy_set_query(query_info):
+    """Builds the query filter by filter, as _EndpointsQueryInfo.SetQuery did before query templates were cached."""
+    entity = query_info._entity
+    for prop in entity._properties.itervalues():
+        current_value = prop._retrieve_value(entity)
+        if current_value is not None:
+            query_info._AddFilter(prop == current_value)
+    query = entity.query()
+    for simple_filter in query_info._filters:
+        query = query.filter(simple_filter)
+    for order_attr in query_info._order_attrs:
+        query = query.order(order_attr)
+    return query
+
+
+def run_query_templates(args):
+    from server.models import model_base
+    from server.models.users import Users
+    from server.models.tasks import Tasks
+
+    def request_query_info(owner):
+        request_entity = Tasks()
+        request_entity.from_json({'owner': owner})
+        query_info = request_entity._endpoints_query_info
+        query_info.order = '-date_completed'
+        return query_info
+
+    with stubs():
+        owner = Users(id='owner', username='owner', password='password').key.urlsafe()
+        results = {}
+        for name, func in (('before', lambda: legacy_set_query(request_query_info(owner))),
+                           ('after', lambda: request_query_info(owner).SetQuery())):
+            seconds = min(timeit.repeat(func, number=args.requests, repeat=5))
+            results[name] = seconds / args.requests * 1e6
+
+    print 'query building per request: before %.1f us, after %.1f us, saved %.1f us' % (
+        results['before'], results['after'], results['before'] - results['after'])
+    print 'template cache: %r' % (model_base.query_template_stats(),)
+    return 0
+
+
+def run_entity_overhead(args):
+    """Decodes entities from protocol buffers the way NDB loads query results, then serializes them, for a plain
+    ndb.Model and for Tasks."""
+    from google.appengine.ext import ndb
+    from server.models.tasks import Tasks
+
+    class PlainTasks(ndb.Model):
+        owner = ndb.KeyProperty(kind='Users', required=True)
+        title = ndb.StringProperty(required=True)
+        date_completed = ndb.DateTimeProperty(auto_now_add=True)
+
+    def objects_per_entity(model_class, pbs):
+        gc.collect()
+        before = len(gc.get_objects())
+        entities = [model_class._from_pb(pb) for pb in pbs]
+        gc.collect()
+        return (len(gc.get_objects()) - before) / float(len(entities))
+
+    def microseconds_per_entity(func, pbs):
+        return min(timeit.repeat(lambda: [func(pb) for pb in pbs], number=1, repeat=5)) / len(pbs) * 1e6
+
+    with stubs():
+        owner = ndb.Key('Users', 'owner')
+        results = {}
+        for model_class, serialize in ((PlainTasks, lambda entity: entity.to_dict()),
+                                       (Tasks, lambda entity: entity.to_json())):
+            pbs = [model_class(id=i + 1, owner=owner, title='task%d' % i)._to_pb() for i in xrange(args.entities)]
+            results[model_class.__name__] = {
+                'objects': objects_per_entity(model_class, pbs),
+                'load_us': microseconds_per_entity(model_class._from_pb, pbs),
+                'load_and_to_json_us': microseconds_per_entity(lambda pb: serialize(model_class._from_pb(pb)), pbs),
+            }
+
+    print '%-10s %14s %10s %20s' % ('model', 'gc objects/e', 'load us/e', 'load+serialize us/e')
+    for name, result in sorted(results.iteritems()):
+        print '%-10s %14.1f %10.1f %20.1f' % (name, result['objects'], result['load_us'], result['load_and_to_json_us'])
+    return 0
+
+
+def run_batch(args):
+    def single(testapp, items):
+        for item in items:
+            testapp.post('/tasks', params=json.dumps(item), content_type='application/json')
+
+    def batched(testapp, items):
+        for start in xrange(0, len(items), args.batch_size):
+            testapp.post('/tasks:batch', params=json.dumps(items[start:start + args.batch_size]),
+                         content_type='application/json')
+
+    results = {}
+    for name, func in (('single', single), ('batch', batched)):
+        with stubs():
+            testapp, owner = logged_in_app('bench')
+            items = [{'owner': owner, 'title': 'task%d' % i} for i in xrange(args.tasks)]
+            start = time.time()
+            func(testapp, items)
+            seconds = time.time() - start
+        results[name] = {'tasks_per_sec': args.tasks / seconds, 'us_per_task': seconds / args.tasks * 1e6}
+
+    for name in ('single', 'batch'):
+        print '%-6s %10.0f tasks/s %10.0f us/task' % (name, results[name]['tasks_per_sec'], results[name]['us_per_task'])
+    return 0
+
+
+class ImportTimer(object):
+    """Wraps __import__ to record the time spent in each module, minus the time of the modules it imports."""
+
+    def __init__(self):
+        self.self_times = collections.Counter()
+        self.stack = []
+
+    def __call__(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        loaded = name in sys.modules
+        self.stack.append(0.0)
+        start = time.time()
+        try:
+            return _builtin_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            nested = self.stack.pop()
+            if not loaded:
+                self.self_times[name] += elapsed - nested
+            if self.stack:
+                self.stack[-1] += elapsed
+
+    def measure(self, module):
+        """Imports module, returning the seconds taken."""
+        __builtin__.__import__ = self
+        start = time.time()
+        try:
+            __import__(module)
+        finally:
+            __builtin__.__import__ = _builtin_import
+        return time.time() - start
+
+
+def run_startup(args):
+    """Imports server.main, then each deferred module (server.forms by default, the cost deferred to the first HTML
+    request), timing every import statement. The modules are listed by their own import time, excluding the modules
+    they import."""
+    if 'server.main' in sys.modules:
+        sys.stderr.write('server.main is already imported, run startup in a fresh process.\n')
+        return 1
+    timer = ImportTimer()
+    print 'server.main imported in %.1fms' % (timer.measure('server.main') * 1000)
+    print 'Slowest modules:'
+    for name, seconds in timer.self_times.most_common(args.listed):
+        print '  %8.1fms  %s' % (seconds * 1000, name)
+
+    for module in args.modules or DEFERRED_MODULES:
+        print 'Deferred %s imported in %.1fms' % (module, ImportTimer().measure(module) * 1000)
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    benchmarks = parser.add_subparsers(dest='benchmark')
+
+    api = benchmarks.add_parser('api', help='latency and RPCs of the API scenarios')
+    api.add_argument('--users', type=int, default=10)
+    api.add_argument('--tasks', type=int, default=20, help='tasks per user')
+    api.add_argument('--iterations', type=int, default=100)
+    api.add_argument('--output', help='file the JSON results are written to, stdout if not given')
+    api.add_argument('--compare', help='JSON results of a baseline run')
+    api.add_argument('--threshold', type=float, default=0.2, help='allowed relative regression')
+    api.set_defaults(run=run_api)
+
+    codec = benchmarks.add_parser('codec', help='entity JSON serialization before and after the compiled codec')
+    codec.add_argument('--entities', type=int, default=5000)
+    codec.add_argument('--rounds', type=int, default=5)
+    codec.set_defaults(run=run_codec)
+
+    query_templates = benchmarks.add_parser('query_templates', help='query building before and after templates')
+    query_templates.add_argument('--requests', type=int, default=10000)
+    query_templates.set_defaults(run=run_query_templates)
+
+    entity_overhead = benchmarks.add_parser('entity_overhead', help='cost of ModelBase per loaded entity')
+    entity_overhead.add_argument('--entities', type=int, default=5000)
+    entity_overhead.set_defaults(run=run_entity_overhead)
+
+    batch = benchmarks.add_parser('batch', help='task creation through POST /tasks and POST /tasks:batch')
+    batch.add_argument('--tasks', type=int, default=1000)
+    batch.add_argument('--batch-size', type=int, default=500)
+    batch.set_defaults(run=run_batch)
+
+    startup = benchmarks.add_parser('startup', help='import cost of a new instance, in a fresh process')
+    startup.add_argument('--listed', type=int, default=25, help='number of modules listed')
+    startup.add_argument('modules', nargs='*', help='deferred modules imported after server.main')
+    startup.set_defaults(run=run_startup)
+
+    args = parser.parse_args(argv[1:])
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,10 +1,32 @@
 import unittest
+import collections
+import threading
+import time
 import webtest
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from webapp2_extras import json
+from webapp2_extras import security
 from server.main import app
+from server.commons import counters
+from server.commons import exceptions
+from server.commons import search_index
+from server.commons import singleflight
+from server.commons import stats
+from server.models.users import Users, user_cache
+from server.models.tasks import Tasks
+from server.models.model_base import MAX_BATCH_ITEMS, QueryShape, _data_etag, query_templates
+from server.jobs.migrate_users import migrate_users
+from server.jobs.reconcile_counters import reconcile_counters
+from server.jobs.reindex_search import reindex_search
 
 USER_PATH = '/users'
+TASK_PATH = '/tasks'
+TASK_BATCH_PATH = '/tasks:batch'
+TOKEN_PATH = '/tokens'
 USER = {'username': 'jideobs', 'password': 'mychora', 'confirm_password': 'mychora'}
 
 
@@ -14,12 +36,16 @@ class TestCasesBase(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_memcache_stub()
         self.testbed.init_datastore_v3_stub()
+        self.testbed.init_search_stub()
+        self.testbed.init_taskqueue_stub()
         self.testapp = webtest.TestApp(app)
+        user_cache.clear()
+        singleflight.clear()
 
     def tearDown(self):
         self.testbed.deactivate()
 
-    def executeReq(self, path, method='post', data=None, cont_type='json', expected_status=200):
+    def executeReq(self, path, method='post', data=None, cont_type='json', expected_status=200, headers=None):
         if cont_type == 'form':
             content_type = 'application/x-www-form-urlencoded'
         else:
@@ -27,15 +53,43 @@ class TestCasesBase(unittest.TestCase):
 
         json_data = json.encode(data) if 'json' in content_type else data
         if method == 'post':
-            return self.testapp.post(path, params=json_data, content_type=content_type, status=expected_status)
+            return self.testapp.post(path, params=json_data, content_type=content_type, status=expected_status,
+                                     headers=headers)
         elif method == 'put':
-            return self.testapp.put(path, params=json_data, content_type=content_type, status=expected_status)
+            return self.testapp.put(path, params=json_data, content_type=content_type, status=expected_status,
+                                    headers=headers)
         elif method == 'delete':
-            return self.testapp.delete(path, status=expected_status)
+            return self.testapp.delete(path, status=expected_status, headers=headers)
         elif method == 'head':
-            return self.testapp.head(path, status=expected_status)
+            return self.testapp.head(path, status=expected_status, headers=headers)
         elif method == 'get':
-            return self.testapp.get(path, status=expected_status)
+            return self.testapp.get(path, status=expected_status, headers=headers)
+
+    def count_rpcs(self, service='datastore_v3'):
+        """Returns a Counter of the RPC calls made to service from now on."""
+        counts = collections.Counter()
+
+        def hook(service, call, request, response):
+            counts[call] += 1
+
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('count_rpcs_%d' % id(counts), hook, service)
+        return counts
+
+    def login(self):
+        self.executeReq('/register', data=USER, cont_type='form', expected_status=302)
+        login_data = {'username': USER['username'], 'password': USER['password']}
+        self.executeReq('/login', data=login_data, cont_type='form', expected_status=302)
+        return Users.get_by_username(USER['username'])
+
+    def run_deferred(self):
+        """Runs the deferred tasks in the default queue, including the ones they defer, until it is empty."""
+        taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = taskqueue.get_filtered_tasks()
+        while tasks:
+            taskqueue.FlushQueue('default')
+            for task in tasks:
+                deferred.run(task.payload)
+            tasks = taskqueue.get_filtered_tasks()
 
 
 class RegisterLoginTestCases(TestCasesBase):
@@ -43,6 +97,10 @@ class RegisterLoginTestCases(TestCasesBase):
         res = self.executeReq('/register', data=USER, cont_type='form', expected_status=302)
         self.assertEqual(res.status_int, 302)
 
+    def testRegisteredUserKeyedByUsername(self):
+        self.executeReq('/register', data=USER, cont_type='form', expected_status=302)
+        self.assertEqual(Users.get_by_id(USER['username']).username, USER['username'])
+
     def testAlreadyRegisteredUser(self):
         self.executeReq('/register', data=USER, cont_type='form', expected_status=302)
         res = self.executeReq('/register', data=USER, cont_type='form')
@@ -70,3 +128,735 @@ class RegisterLoginTestCases(TestCasesBase):
         login_data = {'username': USER['username'], 'password': USER['password']}
         self.executeReq('/login', data=login_data, cont_type='form', expected_status=302)
         self.executeReq('/logout', method='get', expected_status=302)
+
+    def testApiCreateDoesNotOverwriteUser(self):
+        self.executeReq('/register', data=USER, cont_type='form', expected_status=302)
+        data = {'username': USER['username'], 'password': 'other'}
+        self.executeReq(USER_PATH, data=data, expected_status=409)
+        self.assertNotEqual(Users.get_by_id(USER['username']).password, 'other')
+
+    def testUsernameCannotChange(self):
+        self.executeReq('/register', data=USER, cont_type='form', expected_status=302)
+        path = '%s/%s' % (USER_PATH, ndb.Key(Users, USER['username']).urlsafe())
+        self.executeReq(path, method='put', data={'username': 'renamed'}, expected_status=400)
+        self.assertIsNone(Users.get_by_id('renamed'))
+
+    def testWarmup(self):
+        self.executeReq('/_ah/warmup', method='get')
+        self.assertIn('_json_codec', Tasks.__dict__)
+
+
+class UserCacheTestCases(TestCasesBase):
+    def testGetCachedSkipsDatastore(self):
+        Users(username='cached', password='pass').put()
+        self.assertEqual(Users.get_cached('cached').username, 'cached')
+        Users.query().get().key.delete()
+        self.assertEqual(Users.get_cached('cached').username, 'cached')
+
+    def testPutInvalidatesCache(self):
+        user = Users(username='cached', password='pass')
+        user.put()
+        self.assertFalse(Users.get_cached('cached').is_authenticated)
+        user.is_authenticated = True
+        user.put()
+        self.assertTrue(Users.get_cached('cached').is_authenticated)
+
+    def testStaleReadIsNotCached(self):
+        Users(username='cached', password='pass').put()
+        get_by_username = Users.__dict__['get_by_username']
+
+        def racing_get_by_username(cls, username):
+            user = get_by_username.__get__(None, cls)(username)
+            # Another request writes the user after this one read it, and before it is cached.
+            concurrent = Users.get_by_id(username, use_cache=False)
+            concurrent.is_authenticated = True
+            concurrent.put()
+            return user
+
+        Users.get_by_username = classmethod(racing_get_by_username)
+        try:
+            self.assertFalse(Users.get_cached('cached').is_authenticated)
+        finally:
+            Users.get_by_username = get_by_username
+        self.assertTrue(Users.get_cached('cached').is_authenticated)
+
+    def testLogoutWritesStoredUser(self):
+        self.login()
+        user = Users.get_by_id(USER['username'])
+        user.password = 'changed'
+        user.put()
+        self.executeReq('/logout', method='get', expected_status=302)
+        user = Users.get_by_id(USER['username'], use_cache=False, use_memcache=False)
+        self.assertEqual(user.password, 'changed')
+        self.assertFalse(user.is_authenticated)
+
+
+class FilterDataTestCases(TestCasesBase):
+    def testSingleMatch(self):
+        key = Users(username='single', password='pass').put()
+        self.assertEqual(Users.from_filter_data({'username': 'single'}).key, key)
+        self.assertEqual(Users.from_filter_data({'id': key.urlsafe(), 'username': 'single'}).key, key)
+        self.assertIsNone(Users.from_filter_data({'id': key.urlsafe(), 'username': 'other'}))
+        self.assertIsNone(Users.from_filter_data({'username': 'missing'}))
+
+    def testTypedQueryStringFilters(self):
+        Users(username='active', password='pass', is_authenticated=True).put()
+        Users(username='inactive', password='pass').put()
+        res = self.executeReq(USER_PATH + '?is_authenticated=true', method='get')
+        self.assertEqual([user['username'] for user in json.decode(res.body)['data']], ['active'])
+        self.executeReq(USER_PATH + '?is_authenticated=maybe', method='get', expected_status=400)
+
+    def testAmbiguousMatchIsBounded(self):
+        ndb.put_multi([Users(username='user%d' % i, password='same') for i in range(20)])
+        rpcs = self.count_rpcs()
+        self.assertRaises(exceptions.AmbiguousFilterError, Users.from_filter_data, {'password': 'same'})
+        self.assertEqual(rpcs['Get'], 0)
+
+
+    def testIdOfAnotherKind(self):
+        key = Users(username='other', password='pass').put()
+        self.login()
+        self.executeReq('%s/%s' % (TASK_PATH, key.urlsafe()), data={'title': 'task'}, expected_status=400)
+
+    def testAnonymousWriteLooksNothingUp(self):
+        key = Tasks(owner=ndb.Key(Users, 'owner'), title='task').put()
+        ndb.get_context().clear_cache()
+        rpcs = self.count_rpcs()
+        self.executeReq('%s/%s' % (TASK_PATH, key.urlsafe()), data={'title': 'task'}, expected_status=401)
+        # A lookup started and dropped would still be queued on the event loop of the thread.
+        ndb.eventloop.run()
+        self.assertEqual(rpcs['Get'], 0)
+
+
+class ConditionalRequestTestCases(TestCasesBase):
+    def setUp(self):
+        super(ConditionalRequestTestCases, self).setUp()
+        self.user_path = '%s/%s' % (USER_PATH, Users(username='etag', password='pass').put().urlsafe())
+
+    def testEntityNotModified(self):
+        etag = self.executeReq(self.user_path, method='get').headers['ETag']
+        res = self.executeReq(self.user_path, method='get', headers={'If-None-Match': etag}, expected_status=304)
+        self.assertEqual(res.body, '')
+
+    def testCollectionNotModified(self):
+        etag = self.executeReq(USER_PATH, method='get').headers['ETag']
+        self.executeReq(USER_PATH, method='get', headers={'If-None-Match': etag}, expected_status=304)
+
+    def testConditionalPut(self):
+        etag = self.executeReq(self.user_path, method='get').headers['ETag']
+        data = {'password': 'newpass'}
+        res = self.executeReq(self.user_path, method='put', data=data, headers={'If-Match': etag})
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.executeReq(self.user_path, method='put', data=data, headers={'If-Match': etag}, expected_status=412)
+
+    def testConditionalPutChecksCommittedEntity(self):
+        etag = self.executeReq(self.user_path, method='get').headers['ETag']
+        lookup = Users.from_filter_data_async
+
+        @ndb.tasklet
+        def racing_lookup(cls, filter_data):
+            entity = yield lookup(filter_data)
+            # Another request commits a write after this one looked the entity up.
+            concurrent = Users.get_by_id('etag', use_cache=False)
+            concurrent.password = 'changed'
+            yield concurrent.put_async()
+            raise ndb.Return(entity)
+
+        Users.from_filter_data_async = classmethod(racing_lookup)
+        try:
+            self.executeReq(self.user_path, method='put', data={'password': 'newpass'}, headers={'If-Match': etag},
+                            expected_status=412)
+        finally:
+            del Users.from_filter_data_async
+        self.assertEqual(Users.get_by_id('etag', use_cache=False).password, 'changed')
+
+
+    def testTransformedResponseIsTaggedAsEmitted(self):
+        owner = self.login().key.urlsafe()
+        res = self.executeReq(TASK_PATH, data={'owner': owner, 'title': 'task'})
+        body = json.decode(res.body)
+        self.assertIsInstance(body['owner'], dict)
+        self.assertEqual(res.headers['ETag'], '"%s"' % _data_etag(body))
+        self.assertNotEqual(res.headers['ETag'], '"%s"' % ndb.Key(urlsafe=body['id']).get().etag())
+
+        task_path = '%s/%s' % (TASK_PATH, body['id'])
+        etag = res.headers['ETag']
+        self.executeReq(task_path, data={'title': 'renamed'}, headers={'If-Match': etag})
+        self.executeReq(task_path, data={'title': 'again'}, headers={'If-Match': etag}, expected_status=412)
+
+
+class TokenAuthTestCases(TestCasesBase):
+    def setUp(self):
+        super(TokenAuthTestCases, self).setUp()
+        self.executeReq('/register', data=USER, cont_type='form', expected_status=302)
+        self.owner = Users.get_by_username(USER['username']).key.urlsafe()
+
+    def issue_token(self):
+        res = self.executeReq(TOKEN_PATH, data={'username': USER['username'], 'password': USER['password']})
+        # WSGI header values are byte strings.
+        return str(json.decode(res.body)['token'])
+
+    def create_task(self, token, expected_status=200):
+        headers = {'Authorization': 'Bearer %s' % token}
+        return self.executeReq(TASK_PATH, data={'owner': self.owner, 'title': 'task'}, headers=headers,
+                               expected_status=expected_status)
+
+    def testIssueTokenReadsOnce(self):
+        rpcs = self.count_rpcs()
+        self.issue_token()
+        self.assertLessEqual(rpcs['Get'], 1)
+        self.assertEqual(rpcs['Put'], 0)
+
+    def testInvalidCredentials(self):
+        self.executeReq(TOKEN_PATH, data={'username': USER['username'], 'password': 'wrong'}, expected_status=401)
+        self.executeReq(TOKEN_PATH, data={'username': USER['username']}, expected_status=400)
+
+    def testTokenAuthenticatesApiRequests(self):
+        token = self.issue_token()
+        self.create_task(token)
+        self.create_task(token[:-2], expected_status=401)
+        self.create_task('', expected_status=401)
+
+    def testRevokedToken(self):
+        token, other_token = self.issue_token(), self.issue_token()
+        self.executeReq(TOKEN_PATH, method='delete', headers={'Authorization': 'Bearer %s' % token})
+        self.create_task(token, expected_status=401)
+        self.create_task(other_token)
+
+        memcache.flush_all()
+        self.create_task(token, expected_status=401)
+
+    def testPasswordChangeInvalidatesTokens(self):
+        token = self.issue_token()
+        user = Users.get_by_username(USER['username'])
+        user.password = security.generate_password_hash('changed', length=32)
+        user.put()
+        self.create_task(token, expected_status=401)
+
+    def testDeletedUserTokensAreInvalid(self):
+        token = self.issue_token()
+        self.create_task(token)
+        user_path = '%s/%s' % (USER_PATH, self.owner)
+        self.executeReq(user_path, method='delete', headers={'Authorization': 'Bearer %s' % token})
+        self.create_task(token, expected_status=401)
+
+
+class StatsTestCases(TestCasesBase):
+    def testStatsRequireAdmin(self):
+        self.executeReq('/_stats', method='get', expected_status=403)
+
+    def testStatsCountRpcsPerEndpoint(self):
+        Tasks(owner=Users(username='owner', password='pass').put(), title='task').put()
+        stats.reset()
+        self.executeReq(TASK_PATH, method='get')
+        self.executeReq(TASK_PATH, method='get')
+        self.testbed.setup_env(USER_IS_ADMIN='1', USER_EMAIL='admin@example.com', overwrite=True)
+        endpoint = json.decode(self.executeReq('/_stats', method='get').body)['endpoints']['GET /tasks']
+        self.assertEqual(endpoint['requests'], 2)
+        self.assertEqual(endpoint['rpcs']['datastore_v3.RunQuery'], 1)
+        self.assertIn('p99', endpoint['latency_ms'])
+
+    def testStatsReportCacheHitRatesPerKind(self):
+        user_path = '%s/%s' % (USER_PATH, Users(username='owner', password='pass').put().urlsafe())
+        ndb.get_context().clear_cache()
+        stats.reset()
+        self.executeReq(user_path, method='get')
+        ndb.get_context().clear_cache()
+        self.executeReq(user_path, method='get')
+        self.testbed.setup_env(USER_IS_ADMIN='1', USER_EMAIL='admin@example.com', overwrite=True)
+        res = json.decode(self.executeReq('/_stats', method='get').body)
+        self.assertEqual(res['kinds']['Users']['memcache_lookups'], 2)
+        self.assertEqual(res['kinds']['Users']['memcache_hits'], 1)
+        self.assertEqual(res['kinds']['Users']['datastore_gets'], 1)
+        self.assertEqual(res['cache_policies']['Tasks']['use_memcache'], False)
+
+
+class CachePolicyTestCases(TestCasesBase):
+    def testMemcachePolicyPerKind(self):
+        user_key = Users(username='owner', password='pass').put()
+        task_key = Tasks(owner=user_key, title='task').put()
+        ndb.get_context().clear_cache()
+        self.assertEqual(Tasks.from_filter_data({'id': task_key.urlsafe()}).title, 'task')
+        Users.get_by_username('owner')
+        self.assertIsNone(memcache.get(ndb.Context._memcache_prefix + task_key.urlsafe()))
+        self.assertIsNotNone(memcache.get(ndb.Context._memcache_prefix + user_key.urlsafe()))
+
+    def testReadPolicyAppliedToQueries(self):
+        Tasks._read_policy = ndb.EVENTUAL_CONSISTENCY
+        try:
+            query_info = Tasks()._endpoints_query_info
+            self.assertEqual(query_info.fetch_options['read_policy'], ndb.EVENTUAL_CONSISTENCY)
+        finally:
+            Tasks._read_policy = None
+
+
+class ProfilerTestCases(TestCasesBase):
+    def testProfileHeaderRequiresAdmin(self):
+        res = self.executeReq(TASK_PATH, method='get', headers={'X-Profile': '1'})
+        self.assertNotIn('X-Profile-Id', res.headers)
+
+    def testAdminProfile(self):
+        self.testbed.setup_env(USER_IS_ADMIN='1', USER_EMAIL='admin@example.com', overwrite=True)
+        res = self.executeReq(TASK_PATH, method='get', headers={'X-Profile': '1'})
+        profile_path = '/_admin/profiles/%s' % res.headers['X-Profile-Id']
+        profile = json.decode(self.executeReq(profile_path, method='get').body)
+        self.assertEqual(profile['path'], TASK_PATH)
+        self.assertIn('handler', [name for name, _ in profile['spans']])
+        self.assertIn('cumulative', profile['stats'])
+        listed = json.decode(self.executeReq('/_admin/profiles', method='get').body)['data']
+        self.assertEqual([item['id'] for item in listed], [profile['id']])
+
+
+class MigrateUsersTestCases(TestCasesBase):
+    def testMigrateLegacyUser(self):
+        legacy_key = Users(id=42, username='legacy', password='pass').put()
+        for i in range(3):
+            Tasks(owner=legacy_key, title='task%d' % i).put()
+
+        self.assertIsNone(migrate_users(batch_size=2))
+
+        new_key = Users.get_by_id('legacy').key
+        self.assertIsNotNone(legacy_key.get())
+        # One batch of tasks per run, the rest is deferred.
+        self.assertEqual(Tasks.query(Tasks.owner == legacy_key).count(), 1)
+        self.run_deferred()
+        self.assertIsNone(legacy_key.get())
+        self.assertEqual(set(task.owner for task in Tasks.query()), {new_key})
+        self.assertEqual(Users.get_by_username('legacy').key, new_key)
+
+
+    def testMigrateUsersRequiresAdmin(self):
+        self.testapp.post('/_admin/jobs/migrate_users', status=403)
+
+
+class TasksTestCases(TestCasesBase):
+    def setUp(self):
+        super(TasksTestCases, self).setUp()
+        self.owners = [Users(username='owner%d' % i, password='pass').put() for i in range(2)]
+        for i in range(6):
+            Tasks(owner=self.owners[i % 2], title='task%d' % i).put()
+
+    def testGetTasksResolvesOwners(self):
+        res = self.executeReq(TASK_PATH, method='get')
+        data = json.decode(res.body)['data']
+        self.assertEqual(len(data), 6)
+        for task in data:
+            self.assertIn(task['owner']['username'], ('owner0', 'owner1'))
+
+    def testProjectionNeedsIndex(self):
+        self.assertIsNone(QueryShape(projection=('title',)).index_properties())
+        self.assertEqual(QueryShape(filters=('owner',), projection=('title',)).index_properties(),
+                         [('owner', True), ('title', True)])
+        self.assertEqual(QueryShape(filters=('owner',), order='-date_completed',
+                                    projection=('date_completed', 'title')).index_properties(),
+                         [('owner', True), ('date_completed', False), ('title', True)])
+
+    def testProjectionOfFilteredProperty(self):
+        self.executeReq(TASK_PATH + '?owner=%s&fields=owner' % self.owners[0].urlsafe(), method='get',
+                        expected_status=400)
+
+    def testIdOnlyFieldsAreKeysOnly(self):
+        data = json.decode(self.executeReq(TASK_PATH + '?fields=id', method='get').body)['data']
+        self.assertEqual(len(data), 6)
+        self.assertEqual(set(task.keys()[0] for task in data), {'id'})
+        self.assertTrue(all(len(task) == 1 for task in data))
+
+    def testProjectionQueryShapeIsChecked(self):
+        shapes = []
+        Tasks._check_query_shape = classmethod(lambda cls, shape: shapes.append(shape))
+        try:
+            self.executeReq(TASK_PATH + '?owner=%s&fields=title' % self.owners[0].urlsafe(), method='get')
+        finally:
+            del Tasks._check_query_shape
+        self.assertEqual(shapes, [QueryShape(filters=('owner',), projection=('title',))])
+
+    def testResolveReferencesDeduplicatesKeys(self):
+        tasks = Tasks.query().fetch()
+        references = Tasks.resolve_references(tasks)
+        self.assertEqual(sorted(references.keys()), sorted(self.owners))
+
+    def testJsonCodecRoundTrip(self):
+        task = Tasks.query().get()
+        data = task.to_json()
+        self.assertEqual(data['owner'], task.owner.urlsafe())
+        copy = Tasks()
+        copy.from_json(data)
+        self.assertEqual(copy.owner, task.owner)
+        self.assertEqual(copy.date_completed, task.date_completed.replace(microsecond=0))
+
+    def testGetTasksLimit(self):
+        res = json.decode(self.executeReq(TASK_PATH + '?limit=4', method='get').body)
+        self.assertEqual(len(res['data']), 4)
+        self.assertTrue(res['next_page'])
+        self.executeReq(TASK_PATH + '?limit=zero', method='get', expected_status=400)
+
+    def testGetTasksProjection(self):
+        res = json.decode(self.executeReq(TASK_PATH + '?fields=title', method='get').body)
+        for task in res['data']:
+            self.assertEqual(sorted(task.keys()), ['id', 'title'])
+        self.executeReq(TASK_PATH + '?fields=unknown', method='get', expected_status=400)
+
+    def testGetTasksKeysOnly(self):
+        res = json.decode(self.executeReq(TASK_PATH + '?keys_only=true', method='get').body)
+        self.assertEqual(len(res['data']), 6)
+        for task in res['data']:
+            self.assertEqual(task.keys(), ['id'])
+
+    def testGetTasksFilteredAndOrdered(self):
+        owner = self.owners[0].urlsafe()
+        res = json.decode(self.executeReq(TASK_PATH + '?owner=%s&order=-title' % owner, method='get').body)
+        self.assertEqual([task['title'] for task in res['data']], ['task4', 'task2', 'task0'])
+
+    def testGetTasksRangeFilter(self):
+        res = json.decode(self.executeReq(TASK_PATH + '?title__gte=task3&order=title', method='get').body)
+        self.assertEqual([task['title'] for task in res['data']], ['task3', 'task4', 'task5'])
+        self.executeReq(TASK_PATH + '?title__gte=task3&order=owner', method='get', expected_status=400)
+        self.executeReq(TASK_PATH + '?title__like=task3', method='get', expected_status=400)
+
+    def testQueryTemplateReused(self):
+        query_templates.clear()
+        for owner in self.owners:
+            res = json.decode(self.executeReq(TASK_PATH + '?owner=%s' % owner.urlsafe(), method='get').body)
+            self.assertEqual(set(task['owner']['username'] for task in res['data']),
+                             {owner.get().username})
+        self.assertEqual(query_templates.stats()['misses'], 1)
+        self.assertEqual(query_templates.stats()['hits'], 1)
+
+    def testFetchedEntitiesHaveNoQueryInfo(self):
+        for task in Tasks.query().fetch():
+            self.assertNotIn('_query_info', task.__dict__)
+            self.assertNotIn('_from_datastore', task.__dict__)
+
+    def testCollectionCacheInvalidatedByGeneration(self):
+        self.assertEqual(len(json.decode(self.executeReq(TASK_PATH, method='get').body)['data']), 6)
+        Tasks(owner=self.owners[0], title='task6').put()
+        self.assertEqual(len(json.decode(self.executeReq(TASK_PATH, method='get').body)['data']), 6)
+        Tasks.invalidate_collection_cache()
+        self.assertEqual(len(json.decode(self.executeReq(TASK_PATH, method='get').body)['data']), 7)
+
+    def testOnlyCachedCollectionsAreInvalidated(self):
+        self.login()
+        user_path = '%s/%s' % (USER_PATH, self.owners[0].urlsafe())
+        rpcs = self.count_rpcs('memcache')
+        self.executeReq(user_path, method='put', data={'password': 'newpass'})
+        self.assertEqual(rpcs['Increment'], 0)
+        self.executeReq('%s/%s' % (TASK_PATH, Tasks.query().get().key.urlsafe()), data={'title': 'renamed'})
+        self.assertEqual(rpcs['Increment'], 1)
+
+    def testExportNdjson(self):
+        res = self.executeReq(TASK_PATH + '?format=ndjson&owner=%s' % self.owners[1].urlsafe(), method='get')
+        self.assertEqual(res.content_type, 'application/x-ndjson')
+        titles = sorted(json.decode(line)['title'] for line in res.body.splitlines())
+        self.assertEqual(titles, ['task1', 'task3', 'task5'])
+        self.executeReq(TASK_PATH + '?format=xml', method='get', expected_status=400)
+
+
+class TasksBatchTestCases(TestCasesBase):
+    def testBatchCreateAndDelete(self):
+        owner = self.login().key.urlsafe()
+        items = [{'owner': owner, 'title': 'first'}, {'owner': owner}, {'owner': owner, 'title': 'third'}]
+        results = json.decode(self.executeReq(TASK_BATCH_PATH, data=items).body)['data']
+        self.assertEqual([result['status'] for result in results], [200, 400, 200])
+        self.assertEqual(results[0]['data']['owner']['username'], USER['username'])
+        self.assertEqual(Tasks.query().count(), 2)
+
+        ids = [results[0]['data']['id'], results[2]['data']['id'], 'invalid']
+        res = self.testapp.delete(TASK_BATCH_PATH, params=json.encode(ids), content_type='application/json')
+        results = json.decode(res.body)['data']
+        self.assertEqual([result['status'] for result in results], [200, 200, 400])
+        self.assertEqual(Tasks.query().count(), 0)
+
+    def testBatchRequiresArray(self):
+        self.login()
+        self.executeReq(TASK_BATCH_PATH, data={'title': 'task'}, expected_status=400)
+
+    def testRepeatedIdsAreRejected(self):
+        owner = self.login().key.urlsafe()
+        task_id = Tasks(owner=ndb.Key(urlsafe=owner), title='task').put().urlsafe()
+        items = [{'id': task_id, 'title': 'first'}, {'owner': owner, 'title': 'new'}, {'id': task_id, 'title': 'second'}]
+        results = json.decode(self.executeReq(TASK_BATCH_PATH, data=items).body)['data']
+        self.assertEqual([result['status'] for result in results], [400, 200, 400])
+        self.assertEqual(ndb.Key(urlsafe=task_id).get().title, 'task')
+
+    def testReturnedEntitiesMustBeBatchItems(self):
+        owner = Users(username='owner', password='pass').put()
+
+        @Tasks.batch_method()
+        def write_other(service, entities):
+            return [Tasks(owner=owner, title='other')]
+
+        with app.test_request_context(TASK_BATCH_PATH, method='POST', data=json.encode([{'owner': owner.urlsafe()}]),
+                                      content_type='application/json'):
+            self.assertRaises(ValueError, write_other, None)
+        self.assertEqual(Tasks.query().count(), 0)
+
+
+class CountersTestCases(TestCasesBase):
+    def total(self, query=''):
+        return json.decode(self.executeReq(TASK_PATH + '?total=1' + query, method='get').body)['total']
+
+    def testTotalsFollowWrites(self):
+        owner = self.login().key.urlsafe()
+        for i in range(2):
+            self.executeReq(TASK_PATH, data={'owner': owner, 'title': 'task%d' % i})
+        items = [{'owner': owner, 'title': 'batch%d' % i} for i in range(2)]
+        results = json.decode(self.executeReq(TASK_BATCH_PATH, data=items).body)['data']
+        self.assertEqual(self.total(), 4)
+        self.assertEqual(self.total('&owner=%s' % owner), 4)
+
+        self.testapp.delete(TASK_BATCH_PATH, params=json.encode([results[0]['data']['id']]),
+                            content_type='application/json')
+        self.assertEqual(self.total(), 3)
+        self.assertEqual(counters.total_async(counters.counter_name('Tasks', 'owner', ndb.Key(urlsafe=owner)))
+                         .get_result(), 3)
+
+    def testOnlyWritesAreCounted(self):
+        owners = [Users(username='owner%d' % i, password='pass').put() for i in range(2)]
+        key = Tasks(owner=owners[0], title='task').put()
+
+        @Tasks.method()
+        def move_without_put(service, task):
+            return task
+
+        with app.test_request_context(TASK_PATH, method='POST', data=json.encode({'owner': owners[1].urlsafe()}),
+                                      content_type='application/json'):
+            move_without_put(None, id=key.urlsafe())
+        name = counters.counter_name('Tasks', 'owner', owners[1])
+        self.assertEqual(counters.total_async(name).get_result(), 0)
+
+    def testReconcileRequiresAdmin(self):
+        self.testapp.post('/_admin/jobs/reconcile_counters/Tasks', status=403)
+
+    def testTotalNeedsCountedQuery(self):
+        self.executeReq(TASK_PATH + '?total=1&title=task', method='get', expected_status=400)
+
+    def testReconcileCounters(self):
+        owners = [Users(username='owner%d' % i, password='pass').put() for i in range(2)]
+        for i in range(5):
+            Tasks(owner=owners[i % 2], title='task%d' % i).put()
+        stale = counters.counter_name('Tasks', 'owner', ndb.Key(Users, 'stale'))
+        counters.update_async({stale: 2}).get_result()
+
+        reconcile_counters('Tasks', batch_size=2)
+        self.run_deferred()
+
+        self.assertEqual(self.total(), 5)
+        self.assertEqual(self.total('&owner=%s' % owners[0].urlsafe()), 3)
+        self.assertEqual(counters.total_async(stale).get_result(), 0)
+
+
+class BatchTestCases(TestCasesBase):
+    def testBatchDispatchesSubRequests(self):
+        user = self.login()
+        Tasks(owner=user.key, title='task').put()
+        sub_requests = [
+            {'path': TASK_PATH},
+            {'path': '%s/%s' % (USER_PATH, user.key.urlsafe())},
+            {'method': 'POST', 'path': TASK_PATH, 'body': {'owner': user.key.urlsafe(), 'title': 'new'}},
+            {'path': '/batch'},
+        ]
+        results = json.decode(self.executeReq('/batch', data=sub_requests).body)['data']
+        self.assertEqual([result['status'] for result in results], [200, 200, 200, 400])
+        self.assertEqual(results[0]['body']['data'][0]['title'], 'task')
+        self.assertEqual(results[1]['body']['username'], USER['username'])
+        self.assertEqual(results[2]['body']['title'], 'new')
+
+    def testBatchOnlyReachesApiResources(self):
+        self.login()
+        sub_requests = [
+            {'path': '/_admin/jobs/migrate_users', 'method': 'POST'},
+            {'path': '/_stats'},
+            {'path': TASK_PATH, 'headers': {'Cookie': 'session=forged', 'X-Appengine-User-Is-Admin': '1'}},
+        ]
+        results = json.decode(self.executeReq('/batch', data=sub_requests).body)['data']
+        self.assertEqual([result['status'] for result in results], [400, 400, 200])
+
+    def testBatchItemsAreCappedAcrossRequests(self):
+        owner = self.login().key.urlsafe()
+        items = [{'owner': owner, 'title': 'task'}] * (MAX_BATCH_ITEMS // 2 + 1)
+        sub_requests = [{'method': 'POST', 'path': TASK_BATCH_PATH, 'body': items}] * 2
+        self.executeReq('/batch', data=sub_requests, expected_status=400)
+        self.assertEqual(Tasks.query().count(), 0)
+
+
+class ConcurrencyTestCases(TestCasesBase):
+    THREADS = 8
+    REQUESTS_PER_THREAD = 5
+
+    def run_client(self, index, errors):
+        """Drives the app as one client, logged in on even indexes, recording every unexpected response."""
+        username = 'concurrent%d' % index
+        testapp = webtest.TestApp(app)
+        logged_in = index % 2 == 0
+        try:
+            if logged_in:
+                testapp.post('/login', params={'username': username, 'password': 'pass'}, status=302)
+            owner = ndb.Key(Users, username).urlsafe()
+            for i in range(self.REQUESTS_PER_THREAD):
+                title = '%s-%d' % (username, i)
+                res = testapp.post(TASK_PATH, params=json.encode({'owner': owner, 'title': title}),
+                                   content_type='application/json', status='*')
+                if not logged_in:
+                    if res.status_int != 401:
+                        errors.append('%s created a task without a session' % username)
+                    continue
+                task = json.decode(res.body)
+                if task['title'] != title or task['owner']['username'] != username:
+                    errors.append('%s got task %r' % (username, task))
+                task = json.decode(testapp.get('%s/%s' % (TASK_PATH, task['id'])).body)
+                if task['title'] != title:
+                    errors.append('%s read back task %r' % (username, task))
+                # Only an authenticated session is redirected away from the login page.
+                if testapp.get('/login', status='*').status_int != 302:
+                    errors.append('%s lost its session' % username)
+        except Exception as e:
+            errors.append('%s failed: %r' % (username, e))
+
+    def testConcurrentRequestsKeepTheirUsers(self):
+        password = security.generate_password_hash('pass', length=32)
+        ndb.put_multi([Users(username='concurrent%d' % i, password=password) for i in range(self.THREADS)])
+        errors = []
+        threads = [threading.Thread(target=self.run_client, args=(i, errors)) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Tasks.query().count(), self.THREADS / 2 * self.REQUESTS_PER_THREAD)
+
+
+class SingleFlightTestCases(TestCasesBase):
+    def testBurstSharesOneRpc(self):
+        key = Tasks(owner=ndb.Key(Users, 'owner'), title='task').put()
+        rpcs = self.count_rpcs()
+
+        def slow_get(service, call, request, response):
+            if call == 'Get':
+                time.sleep(0.2)
+
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('slow_get', slow_get, 'datastore_v3')
+        start = threading.Event()
+        titles = []
+
+        def read():
+            start.wait()
+            titles.append(Tasks.from_filter_data({'id': key.urlsafe()}).title)
+
+        threads = [threading.Thread(target=read) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(titles, ['task'] * 10)
+        self.assertEqual(rpcs['Get'], 1)
+
+    def testMissesAreRemembered(self):
+        filter_data = {'id': ndb.Key(Tasks, 42).urlsafe()}
+        rpcs = self.count_rpcs()
+        for _ in range(2):
+            self.assertIsNone(Tasks.from_filter_data(dict(filter_data)))
+            ndb.get_context().clear_cache()
+        self.assertEqual(rpcs['Get'], 1)
+
+        Tasks(id=42, owner=ndb.Key(Users, 'owner'), title='task').put()
+        ndb.get_context().clear_cache()
+        self.assertEqual(Tasks.from_filter_data(dict(filter_data)).title, 'task')
+
+    def testStalledLeaderIsReplaced(self):
+        key = Tasks(owner=ndb.Key(Users, 'owner'), title='task').put()
+        flight_key = ('get', key, None)
+        # A leader on another thread whose tasklet never resumes.
+        leader = threading.Thread(target=singleflight._join, args=(flight_key,))
+        leader.start()
+        leader.join()
+        stalled = singleflight._calls[flight_key]
+        stalled.deadline = time.time() - 1
+
+        start = time.time()
+        self.assertEqual(singleflight.get_async(key).get_result().title, 'task')
+        self.assertLess(time.time() - start, 1)
+        self.assertNotIn(flight_key, singleflight._calls)
+
+
+class SearchTestCases(TestCasesBase):
+    def search(self, query):
+        return json.decode(self.executeReq(TASK_PATH + '?q=' + query, method='get').body)
+
+    def testWritesUpdateIndex(self):
+        owner = self.login().key.urlsafe()
+        ids = [json.decode(self.executeReq(TASK_PATH, data={'owner': owner, 'title': title}).body)['id']
+               for title in ('buy milk', 'walk the dog', 'buy bread')]
+        self.assertEqual(self.search('buy')['data'], [])
+        self.run_deferred()
+        self.assertEqual(sorted(task['title'] for task in self.search('buy')['data']), ['buy bread', 'buy milk'])
+
+        first = self.search('buy&limit=1')
+        self.assertEqual(len(first['data']), 1)
+        second = self.search('buy&limit=1&next_page=' + first['next_page'])
+        self.assertEqual(len(second['data']), 1)
+        self.assertNotEqual(first['data'][0]['id'], second['data'][0]['id'])
+
+        self.testapp.delete(TASK_BATCH_PATH, params=json.encode(ids[:1]), content_type='application/json')
+        self.run_deferred()
+        self.assertEqual([task['title'] for task in self.search('buy')['data']], ['buy bread'])
+
+    def testInvalidQuery(self):
+        self.login()
+        self.executeReq(TASK_PATH + '?q=' + 'title:(', method='get', expected_status=400)
+
+    def testReindexRequiresAdmin(self):
+        self.testapp.post('/_admin/jobs/reindex_search/Tasks', status=403)
+
+    def testNotSearchable(self):
+        self.executeReq(USER_PATH + '?q=owner', method='get', expected_status=400)
+
+    def testReindexSearch(self):
+        owner = Users(username='owner', password='pass').put()
+        keys = [Tasks(owner=owner, title='task %d' % i).put() for i in range(3)]
+        reindex_search('Tasks', batch_size=2)
+        keys[0].delete()
+        self.run_deferred()
+
+        self.assertEqual(sorted(task['id'] for task in self.search('task')['data']),
+                         sorted(key.urlsafe() for key in keys[1:]))
+        self.assertEqual(len(search_index.get_index('Tasks').get_range(ids_only=True).results), 2)
+
+
+class AsyncTransformTestCases(TestCasesBase):
+    def setUp(self):
+        super(AsyncTransformTestCases, self).setUp()
+        context = ndb.get_context()
+        context.set_cache_policy(False)
+        context.set_memcache_policy(False)
+        for i in range(5):
+            owner = Users(username='owner%d' % i, password='pass').put()
+            Tasks(owner=owner, title='task%d' % i).put()
+
+    def tearDown(self):
+        context = ndb.get_context()
+        context.set_cache_policy(None)
+        context.set_memcache_policy(None)
+        super(AsyncTransformTestCases, self).tearDown()
+
+    def testGetTasksBatchesOwnerLookups(self):
+        tasks = Tasks.query().fetch()
+        rpcs = self.count_rpcs()
+        [task.transform_response() for task in tasks]
+        self.assertEqual(rpcs['Get'], 5)
+
+        rpcs = self.count_rpcs()
+        res = json.decode(self.executeReq(TASK_PATH, method='get').body)
+        self.assertEqual(len(res['data']), 5)
+        self.assertEqual(rpcs['RunQuery'], 1)
+        self.assertEqual(rpcs['Get'], 1)
+
+    def testTaskletApiMethod(self):
+        @Tasks.query_method(transform_response=True)
+        @ndb.tasklet
+        def get(service_instance, query):
+            raise ndb.Return(query.filter(Tasks.title == 'task3'))
+
+        with app.test_request_context(TASK_PATH):
+            output, status, headers = get(None)
+        self.assertEqual([task['owner']['username'] for task in output['data']], ['owner3'])
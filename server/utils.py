@@ -22,3 +22,25 @@ def date_from_str(prop_type, str_date):
 		return main_datetime.datetime.strptime(str_date, DATE_TIME_FORMAT)
 	else:
 		return main_datetime.datetime.strptime(str_date, TIME_FORMAT)
+
+
+def date_encoder(prop_type):
+	"""Returns a function converting values of a date, datetime or time property to strings."""
+	if isinstance(prop_type, ndb.DateProperty):
+		str_format = DATE_FORMAT
+	elif isinstance(prop_type, ndb.TimeProperty):
+		str_format = TIME_FORMAT
+	else:
+		str_format = DATE_TIME_FORMAT
+	return lambda value: value.strftime(str_format)
+
+
+def date_decoder(prop_type):
+	"""Returns a function parsing strings into values of a date, datetime or time property."""
+	strptime = main_datetime.datetime.strptime
+	if isinstance(prop_type, ndb.DateProperty):
+		return lambda str_date: strptime(str_date, DATE_FORMAT).date()
+	elif isinstance(prop_type, ndb.TimeProperty):
+		return lambda str_date: strptime(str_date, TIME_FORMAT).time()
+	else:
+		return lambda str_date: strptime(str_date, DATE_TIME_FORMAT)